@@ -3,6 +3,42 @@
  * Handles user registration, contributor data, and color assignments
  */
 
+// Prebuilt static dataset (scripts/build_bundle.py), used when the API server is not running
+const STATIC_BUNDLE_DIR = 'data/bundle';
+let staticBundlePromise = null;
+
+function loadStaticBundle() {
+    if (!staticBundlePromise) {
+        staticBundlePromise = (async () => {
+            const manifestResponse = await fetch(`${STATIC_BUNDLE_DIR}/manifest.json`, { cache: 'no-cache' });
+            if (!manifestResponse.ok) {
+                throw new Error(`Bundle manifest not found: ${manifestResponse.status}`);
+            }
+            const manifest = await manifestResponse.json();
+
+            // Bundle names are content hashes, so the bundle itself can be cached forever
+            const bundleResponse = await fetch(`${STATIC_BUNDLE_DIR}/${manifest.bundle}`);
+            if (!bundleResponse.ok) {
+                throw new Error(`Bundle not found: ${bundleResponse.status}`);
+            }
+
+            // Servers that send Content-Encoding: gzip are already decoded by the browser
+            let bytes = new Uint8Array(await bundleResponse.arrayBuffer());
+            if (bytes[0] === 0x1f && bytes[1] === 0x8b) {
+                const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+                bytes = new Uint8Array(await new Response(stream).arrayBuffer());
+            }
+
+            const bundle = JSON.parse(new TextDecoder().decode(bytes));
+            console.log(`📦 Loaded static bundle ${manifest.bundle}:`, manifest.counts);
+            return bundle;
+        })();
+        // Allow a retry if the bundle could not be loaded
+        staticBundlePromise.catch(() => { staticBundlePromise = null; });
+    }
+    return staticBundlePromise;
+}
+
 class DataManager {
     constructor() {
         this.users = new Map();
@@ -277,6 +313,22 @@ class DataManager {
             }
         } catch (error) {
             console.error('❌ Error loading contributors from storage:', error);
+            await this.loadContributorsFromBundle();
+        }
+    }
+
+    async loadContributorsFromBundle() {
+        try {
+            const bundle = await loadStaticBundle();
+            Object.entries(bundle.users).forEach(([id, contributor]) => {
+                this.registeredContributors.set(id, contributor);
+            });
+            Object.entries(bundle.contributorColors).forEach(([id, color]) => {
+                this.contributorColors.set(id, color);
+            });
+            console.log('✅ Loaded contributors from static bundle:', Object.keys(bundle.users).length);
+        } catch (error) {
+            console.warn('Static bundle not available:', error.message);
         }
     }
 
@@ -389,6 +441,7 @@ class DataManager {
 class MemoryDataManager {
     constructor() {
         this.memories = new Map();
+        this.bundleTrajectories = {}; // trajectory path -> simplified geometry from the static bundle
         this.currentUser = null;
         this.loadMemoriesFromStorage();
     }
@@ -492,17 +545,58 @@ class MemoryDataManager {
             }
         } catch (error) {
             console.error('❌ Error loading memories from server:', error);
-            throw error;
+            if (!(await this.loadMemoriesFromBundle())) {
+                throw error;
+            }
+        }
+    }
+
+    async loadMemoriesFromBundle() {
+        try {
+            const bundle = await loadStaticBundle();
+            Object.entries(bundle.memories).forEach(([id, memory]) => {
+                this.memories.set(id, memory);
+            });
+            this.bundleTrajectories = bundle.trajectories || {};
+            console.log('✅ Loaded memories from static bundle:', Object.keys(bundle.memories).length);
+            return true;
+        } catch (error) {
+            console.warn('Static bundle not available:', error.message);
+            return false;
         }
     }
 
     async deleteMemory(memoryId) {
         const result = this.memories.delete(memoryId);
         if (result) {
-            await this.saveMemoriesToStorage();
+            await this.deleteMemoriesFromStorage([memoryId]);
         }
         return result;
     }
+
+    async deleteMemoriesFromStorage(memoryIds) {
+        try {
+            // save-all never removes memories, so deletions are sent explicitly
+            const response = await fetch('http://localhost:3001/api/memories/delete', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ ids: memoryIds })
+            });
+
+            if (response.ok) {
+                const result = await response.json();
+                console.log('✅ Successfully deleted memories on server:', result.message);
+            } else {
+                throw new Error(`Server error: ${response.status}`);
+            }
+
+        } catch (error) {
+            console.error('❌ Error deleting memories on server:', error);
+            throw error;
+        }
+    }
 }
 
 // Export for use in other modules
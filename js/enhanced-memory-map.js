@@ -1068,6 +1068,13 @@ class EnhancedMemoryMap {
         // Handle trajectory file paths (new approach)
         if (memory.media && memory.media.trajectories && memory.media.trajectories.length > 0) {
             for (const trajectoryPath of memory.media.trajectories) {
+                // Use the simplified copy from the static bundle when available
+                const bundled = this.dataManager.bundleTrajectories[trajectoryPath];
+                if (bundled) {
+                    this.addTrajectoryLayer(memory, bundled);
+                    continue;
+                }
+
                 try {
                     // Load trajectory from file
                     const response = await fetch(`http://localhost:8000/${trajectoryPath}`);
@@ -1265,10 +1272,15 @@ class EnhancedMemoryMap {
                     // Extract coordinates from GPX
                     const trkpts = xmlDoc.getElementsByTagName('trkpt');
                     const coordinates = [];
+                    const coordTimes = [];
                     for (let i = 0; i < trkpts.length; i++) {
                         const lat = parseFloat(trkpts[i].getAttribute('lat'));
                         const lon = parseFloat(trkpts[i].getAttribute('lon'));
                         coordinates.push([lon, lat]);
+                        
+                        // Keep point times so the server can compute trajectory durations
+                        const time = trkpts[i].getElementsByTagName('time')[0];
+                        coordTimes.push(time ? time.textContent.trim() : null);
                     }
                     
                     this.currentTrajectoryData = {
@@ -1277,6 +1289,9 @@ class EnhancedMemoryMap {
                         format: 'gpx',
                         fileName: file.name
                     };
+                    if (coordTimes.some(time => time)) {
+                        this.currentTrajectoryData.coordTimes = coordTimes;
+                    }
                     
                     console.log(`Parsed GPX trajectory with ${coordinates.length} points`);
                 } else {
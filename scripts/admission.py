@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Admission control
+Per-route request body limits (413), a cap on concurrent heavy requests with a short
+bounded queue (503 + Retry-After) and per-client token-bucket rate limits (429).
+
+  UAL_M2_BODY_LIMITS="/api/upload/image=20M,*=1M"   maximum POST body per route
+  UAL_M2_HEAVY_CONCURRENCY=4                         heavy requests running at once
+  UAL_M2_HEAVY_QUEUE=8                               heavy requests allowed to wait
+  UAL_M2_QUEUE_TIMEOUT=2                             seconds a queued request may wait
+  UAL_M2_RATE=50 / UAL_M2_BURST=100                  per-client requests/second and burst (0 = off)
+
+Clients are told apart by IP address. The server binds localhost, so browsers and any reverse
+proxy all arrive from 127.0.0.1 and the rate limit is in practice one bucket for everyone.
+"""
+
+import functools
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+from profiling import route_key
+
+DEFAULT_BODY_LIMITS = {
+    '/api/users/save': 1024 * 1024,
+    '/api/users/save-all': 10 * 1024 * 1024,
+    '/api/memories/save-all': 20 * 1024 * 1024,
+    '/api/upload/image': 20 * 1024 * 1024,
+    '/api/upload/trajectory': 20 * 1024 * 1024,
+    '*': 1024 * 1024
+}
+
+# Routes that parse or serialize the whole dataset or large uploads
+HEAVY_ROUTES = {
+    ('GET', '/api/users/list'),
+    ('GET', '/api/memories/list'),
+    ('POST', '/api/users/save-all'),
+    ('POST', '/api/memories/save-all'),
+    ('POST', '/api/upload/image'),
+    ('POST', '/api/upload/trajectory'),
+}
+
+MAX_TRACKED_CLIENTS = 10000
+DRAIN_CHUNK = 64 * 1024
+
+def parse_size(text):
+    """Parse a byte size such as 512, 64K, 20M or 1G"""
+    text = str(text).strip().upper().rstrip('B')
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text and text[-1] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
+
+def parse_body_limits(text):
+    """Parse "route=size,...,*=size" on top of the default limits"""
+    limits = dict(DEFAULT_BODY_LIMITS)
+    for part in str(text or '').split(','):
+        part = part.strip()
+        if part:
+            route, _, size = part.rpartition('=')
+            limits[route or '*'] = parse_size(size)
+    return limits
+
+class TokenBucket:
+    """Per-client token buckets refilled at rate tokens/second up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, client):
+        """Take one token; returns 0 when allowed, otherwise seconds until a token is available"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[client] = (tokens - 1, now)
+                return 0
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > MAX_TRACKED_CLIENTS:
+                # Full buckets carry no state worth keeping
+                self._buckets = {
+                    c: (t, l) for c, (t, l) in self._buckets.items()
+                    if t + (now - l) * self.rate < self.burst
+                }
+            return (1 - tokens) / self.rate
+
+class AdmissionController:
+    """Applies body limits, heavy-request concurrency and rate limits before a handler runs"""
+
+    def __init__(self, body_limits=None, heavy_concurrency=4, heavy_queue=8, queue_timeout=2.0,
+                 rate=50.0, burst=100.0):
+        self.body_limits = body_limits or dict(DEFAULT_BODY_LIMITS)
+        self.heavy_concurrency = heavy_concurrency
+        self.heavy_queue = heavy_queue
+        self.queue_timeout = queue_timeout
+        self.buckets = TokenBucket(rate, burst)
+        self.in_flight = 0
+        self.queued = 0
+        self.peak_in_flight = 0
+        self.peak_queued = 0
+        self.admitted = 0
+        self.rejected = Counter()
+        self._slots = threading.Condition()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            body_limits=parse_body_limits(os.environ.get('UAL_M2_BODY_LIMITS')),
+            heavy_concurrency=int(os.environ.get('UAL_M2_HEAVY_CONCURRENCY', 4)),
+            heavy_queue=int(os.environ.get('UAL_M2_HEAVY_QUEUE', 8)),
+            queue_timeout=float(os.environ.get('UAL_M2_QUEUE_TIMEOUT', 2)),
+            rate=float(os.environ.get('UAL_M2_RATE', 50)),
+            burst=float(os.environ.get('UAL_M2_BURST', 100))
+        )
+
+    def body_limit(self, route):
+        return self.body_limits.get(route, self.body_limits.get('*'))
+
+    def _acquire_slot(self):
+        """Wait for a heavy-request slot; False if the queue is full or the wait times out"""
+        with self._slots:
+            if self.in_flight >= self.heavy_concurrency:
+                if self.queued >= self.heavy_queue:
+                    return False
+                self.queued += 1
+                self.peak_queued = max(self.peak_queued, self.queued)
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self.in_flight >= self.heavy_concurrency:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        self._slots.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def _release_slot(self):
+        with self._slots:
+            self.in_flight -= 1
+            self._slots.notify()
+
+    def _drain_body(self, handler):
+        """
+        Read and discard a POST body of up to the route's limit, so a client still sending it
+        reads the rejection instead of a broken pipe; True if the whole body was read
+        """
+        if handler.command != 'POST':
+            return True
+        content_length = handler.headers.get('Content-Length')
+        if content_length is None or not content_length.isdigit():
+            return False
+        length = int(content_length)
+        remaining = min(length, self.body_limit(route_key(handler.path)))
+        try:
+            while remaining > 0:
+                chunk = handler.rfile.read(min(remaining, DRAIN_CHUNK))
+                if not chunk:
+                    return False
+                remaining -= len(chunk)
+        except OSError:
+            return False
+        return length <= self.body_limit(route_key(handler.path))
+
+    def _reject(self, handler, status, reason, message, retry_after=None):
+        with self._slots:
+            self.rejected[reason] += 1
+        # The connection can only be reused if the whole request body was read
+        if not self._drain_body(handler):
+            handler.close_connection = True
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Access-Control-Allow-Origin', '*')
+        if handler.close_connection:
+            handler.send_header('Connection', 'close')
+        if retry_after is not None:
+            handler.send_header('Retry-After', str(max(1, math.ceil(retry_after))))
+        handler.end_headers()
+        handler.wfile.write(json.dumps({"status": "error", "message": message}).encode())
+
+    def handle(self, handler, method):
+        """Run method(handler) if the request is admitted, otherwise send the rejection"""
+        retry_after = self.buckets.take(handler.client_address[0])
+        if retry_after:
+            return self._reject(handler, 429, 'rate_limited', "Too many requests", retry_after)
+
+        route = route_key(handler.path)
+        if handler.command == 'POST':
+            content_length = handler.headers.get('Content-Length')
+            if content_length is None or not content_length.isdigit():
+                return self._reject(handler, 411, 'length_required', "Content-Length required")
+            limit = self.body_limit(route)
+            if int(content_length) > limit:
+                return self._reject(handler, 413, 'body_too_large',
+                                    f"Request body exceeds {limit} bytes for {route}")
+
+        if (handler.command, route) not in HEAVY_ROUTES:
+            with self._slots:
+                self.admitted += 1
+            return method(handler)
+
+        if not self._acquire_slot():
+            return self._reject(handler, 503, 'overloaded', "Server busy, try again shortly", self.queue_timeout)
+        try:
+            with self._slots:
+                self.admitted += 1
+            return method(handler)
+        finally:
+            self._release_slot()
+
+    def stats(self):
+        with self._slots:
+            return {
+                'inFlight': self.in_flight,
+                'queued': self.queued,
+                'peakInFlight': self.peak_in_flight,
+                'peakQueued': self.peak_queued,
+                'heavyConcurrency': self.heavy_concurrency,
+                'heavyQueue': self.heavy_queue,
+                'queueTimeout': self.queue_timeout,
+                'rate': self.buckets.rate,
+                'burst': self.buckets.burst,
+                'bodyLimits': self.body_limits,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected)
+            }
+
+def admission_controlled(method):
+    """Decorator for do_GET / do_POST that runs the request through the server's admission controller"""
+    @functools.wraps(method)
+    def wrapper(handler):
+        controller = getattr(handler.server, 'admission', None)
+        if controller is None:
+            return method(handler)
+        return controller.handle(handler, method)
+    return wrapper
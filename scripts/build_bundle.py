@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+构建前端静态数据包
+把用户、memories、贡献者颜色和简化后的轨迹打包成一个带内容哈希的gzip文件，
+并生成一个很小的manifest指向它。只读部署可以直接用静态服务器提供全部数据。
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from geo_utils import simplify_geometry
+from profiling import run_profiled
+
+BUNDLE_VERSION = 1
+DEFAULT_TOLERANCE = 0.00001  # 约1米，单位为经纬度
+KEEP_OLD_BUNDLES = 2
+
+def load_records(records_dir, summary_prefix):
+    """读取单个记录文件，跳过汇总快照文件"""
+    records = {}
+    for record_file in sorted(glob.glob(os.path.join(records_dir, "*.json"))):
+        if os.path.basename(record_file).startswith(summary_prefix):
+            continue
+        with open(record_file, 'r', encoding='utf-8') as f:
+            record = json.load(f)
+        records[record['id']] = record
+    return records
+
+def load_trajectories(data_dir, memories, tolerance):
+    """读取memories引用的轨迹文件并进行简化"""
+    trajectories = {}
+    for memory in memories.values():
+        media = memory.get('media') or {}
+        for trajectory_path in media.get('trajectories') or []:
+            if trajectory_path in trajectories:
+                continue
+            trajectory_file = os.path.join(data_dir, trajectory_path)
+            if not os.path.exists(trajectory_file):
+                print(f"  ⚠️ 轨迹文件不存在: {trajectory_file}")
+                continue
+            with open(trajectory_file, 'r', encoding='utf-8') as f:
+                trajectories[trajectory_path] = simplify_geometry(json.load(f), tolerance)
+    return trajectories
+
+def build_bundle(data_dir, tolerance=DEFAULT_TOLERANCE):
+    """生成数据包内容（不含时间戳，保证相同数据得到相同哈希）"""
+    users = load_records(os.path.join(data_dir, "users"), "contributors-")
+    memories = load_records(os.path.join(data_dir, "memories"), "memories-")
+
+    # 内联轨迹（旧格式）同样简化
+    for memory in memories.values():
+        if memory.get('trajectory'):
+            memory['trajectory'] = simplify_geometry(memory['trajectory'], tolerance)
+
+    contributor_colors = {
+        user_id: user['color'] for user_id, user in users.items() if user.get('color')
+    }
+
+    return {
+        'version': BUNDLE_VERSION,
+        'users': users,
+        'memories': memories,
+        'contributorColors': contributor_colors,
+        'trajectories': load_trajectories(data_dir, memories, tolerance)
+    }
+
+def write_bundle(bundle, output_dir):
+    """写入压缩数据包和manifest，返回manifest内容"""
+    os.makedirs(output_dir, exist_ok=True)
+
+    payload = json.dumps(bundle, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    content_hash = hashlib.sha256(payload).hexdigest()
+    bundle_name = f"bundle-{content_hash[:16]}.json.gz"
+    bundle_file = os.path.join(output_dir, bundle_name)
+
+    if not os.path.exists(bundle_file):
+        # mtime=0 让相同内容生成完全相同的压缩文件
+        with open(bundle_file, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as gz:
+                gz.write(payload)
+
+    manifest = {
+        'version': BUNDLE_VERSION,
+        'bundle': bundle_name,
+        'sha256': content_hash,
+        'size': os.path.getsize(bundle_file),
+        'uncompressedSize': len(payload),
+        'counts': {
+            'users': len(bundle['users']),
+            'memories': len(bundle['memories']),
+            'trajectories': len(bundle['trajectories'])
+        },
+        'generatedAt': datetime.now().isoformat()
+    }
+
+    # 先写临时文件再替换，避免客户端读到半个manifest
+    manifest_file = os.path.join(output_dir, "manifest.json")
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, manifest_file)
+
+    prune_old_bundles(output_dir, bundle_name)
+    return manifest
+
+def prune_old_bundles(output_dir, current_name):
+    """只保留当前数据包和最近的几个旧版本（给还持有旧manifest的客户端）"""
+    old_bundles = [
+        f for f in glob.glob(os.path.join(output_dir, "bundle-*.json.gz"))
+        if os.path.basename(f) != current_name
+    ]
+    old_bundles.sort(key=os.path.getmtime, reverse=True)
+    for old_file in old_bundles[KEEP_OLD_BUNDLES:]:
+        os.remove(old_file)
+        print(f"  🗑️ 删除旧数据包: {os.path.basename(old_file)}")
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="Build the static front-end data bundle")
+    parser.add_argument('--data-dir', default="data", help="数据目录 (默认: data)")
+    parser.add_argument('--output-dir', default=None, help="输出目录 (默认: <data-dir>/bundle)")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="轨迹简化容差，单位为度 (默认: %(default)s)")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(args.data_dir, "bundle")
+
+    print("📦 开始构建静态数据包...")
+    bundle = build_bundle(args.data_dir, args.tolerance)
+    manifest = write_bundle(bundle, output_dir)
+
+    print(f"✅ 数据包: {manifest['bundle']}")
+    print(f"   - 用户: {manifest['counts']['users']}")
+    print(f"   - memories: {manifest['counts']['memories']}")
+    print(f"   - 轨迹: {manifest['counts']['trajectories']}")
+    print(f"   - 大小: {manifest['uncompressedSize']} → {manifest['size']} bytes (gzip)")
+    print(f"💾 manifest已保存到: {os.path.join(output_dir, 'manifest.json')}")
+
+if __name__ == "__main__":
+    run_profiled(main)
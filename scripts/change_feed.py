@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Change feed shared between server processes
+Every write appends (seq, kind, id) lines to an append-only log under a file lock.
+Each worker process tails the log and drops or refreshes its in-memory caches for
+records written by other workers.
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+@contextmanager
+def file_lock(lock_path):
+    """Exclusive lock across processes (flock) and threads; falls back to a per-path thread lock without fcntl"""
+    if fcntl is None:
+        with _thread_locks_guard:
+            lock = _thread_locks.setdefault(os.path.abspath(lock_path), threading.Lock())
+        with lock:
+            yield
+        return
+
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Entry kind telling a reader that entries it had not read yet were compacted away
+RESYNC = '*'
+
+class ChangeFeed:
+    """
+    Append-only log of record changes; seq numbers increase by one per entry.
+    The first line of a compacted log is a header {"log": id, "baseSeq": n}: entries
+    up to n were dropped. A reader that had not reached n gets a RESYNC entry.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.lock_path = log_path + ".lock"
+        self.last_seq = 0
+        self.log_id = None
+        self._inode = None
+        self._offset = 0
+        self._backlog = []
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+
+    @staticmethod
+    def _read_header(f):
+        """(log id, base seq, header length) of an open log file"""
+        f.seek(0)
+        first_line = f.readline()
+        if not first_line.endswith(b'\n'):
+            return None, 0, 0
+        header = json.loads(first_line)
+        if 'log' not in header:
+            # Log written before compaction existed: no header
+            return None, 0, 0
+        return header['log'], header['baseSeq'], len(first_line)
+
+    def position(self):
+        """(log id, byte offset, seq) this reader has reached; stored in the state snapshot"""
+        with self._lock:
+            return self.log_id, self._offset, self.last_seq
+
+    def skip_to_end(self, position=None):
+        """
+        Start tailing from the current end of the log (state is about to be loaded from disk).
+        position from a snapshot lets it seek past the entries the snapshot already covers
+        instead of parsing the whole log.
+        """
+        with self._lock:
+            if position is not None and position[0] is not None:
+                try:
+                    with open(self.log_path, 'rb') as f:
+                        stat = os.fstat(f.fileno())
+                        if self._read_header(f)[0] == position[0] and position[1] <= stat.st_size:
+                            self.log_id, self._offset, self.last_seq = position
+                            self._inode = stat.st_ino
+                except FileNotFoundError:
+                    pass
+            self._read_new()
+            self._backlog = []
+        return self.last_seq
+
+    def _switch_log(self, f, inode):
+        """Start reading a new log file (first read, or the log was compacted); caller holds self._lock"""
+        log_id, base_seq, header_length = self._read_header(f)
+        # skip_to_end() discards this on the first read
+        if base_seq > self.last_seq:
+            self._backlog.append({'seq': base_seq, 'kind': RESYNC, 'id': None, 'pid': None})
+        self.last_seq = max(self.last_seq, base_seq)
+        self.log_id = log_id
+        self._inode = inode
+        self._offset = header_length
+
+    def _read_new(self):
+        """Move complete entries after the current offset into the backlog; caller holds self._lock"""
+        try:
+            f = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            return
+        # Everything below reads the one file opened here, even if compaction replaces the path
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self._inode:
+                self._switch_log(f, stat.st_ino)
+            if stat.st_size <= self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read(stat.st_size - self._offset)
+        # An entry being written by another process may not be complete yet
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+
+        pid = os.getpid()
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            # A compacted log repeats the entries after its base seq
+            if entry['seq'] <= self.last_seq:
+                continue
+            self.last_seq = entry['seq']
+            # This process applied its own changes when it made them
+            if entry.get('pid') != pid:
+                self._backlog.append(entry)
+
+    def end_offset(self):
+        """Current size of the log; it changes with every append by any process"""
+        try:
+            return os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return 0
+
+    def poll(self):
+        """Entries appended by other processes since the last poll"""
+        with self._lock:
+            self._read_new()
+            entries, self._backlog = self._backlog, []
+        return entries
+
+    def append(self, changes):
+        """Append (kind, id) changes under the feed lock and return the entries written"""
+        if not changes:
+            return []
+        with self._lock, file_lock(self.lock_path):
+            # Catch up first so seq numbers continue from the latest entry of any process
+            self._read_new()
+            entries = []
+            for kind, record_id in changes:
+                self.last_seq += 1
+                entries.append({'seq': self.last_seq, 'kind': kind, 'id': record_id, 'pid': os.getpid()})
+            data = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries).encode('utf-8')
+            with open(self.log_path, 'ab') as f:
+                f.write(data)
+            self._offset += len(data)
+        return entries
+
+    def compact(self, base_seq):
+        """
+        Drop entries up to base_seq (already covered by a state snapshot) by replacing the log
+        with a new one; returns the position() just after base_seq in the new log.
+        """
+        with self._lock, file_lock(self.lock_path):
+            self._read_new()
+            kept = []
+            if os.path.exists(self.log_path):
+                with open(self.log_path, 'rb') as f:
+                    for line in f:
+                        if line.endswith(b'\n') and line.strip():
+                            entry = json.loads(line)
+                            if 'seq' in entry and entry['seq'] > base_seq:
+                                kept.append(line)
+            log_id = os.urandom(8).hex()
+            header = (json.dumps({'log': log_id, 'baseSeq': base_seq}) + '\n').encode('utf-8')
+            tmp_path = f"{self.log_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(header)
+                f.writelines(kept)
+            os.replace(tmp_path, self.log_path)
+            # Re-reads the kept entries of the new file, skipping those already seen
+            self._read_new()
+        return log_id, len(header), base_seq
@@ -9,6 +9,8 @@ import os
 import glob
 from datetime import datetime
 
+from profiling import run_profiled
+
 # 高对比度颜色调色板（与JavaScript中相同）
 HIGH_CONTRAST_COLORS = [
     "#f43d3d", "#b2e5df", "#c1380a", "#b2e5d8", "#f43daf", "#329966", "#f9a99e", "#658ccc",
@@ -283,4 +285,4 @@ def main():
     print(f"   - 数据完整性: 用户文件 + memories文件同步更新")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_profiled(main)
\ No newline at end of file
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+清理未被任何memory引用的上传文件
+扫描所有memory的media.images / media.trajectories，删除孤立文件并统计回收空间
+"""
+
+import argparse
+import os
+from datetime import datetime
+
+from media_store import find_orphans
+from profiling import run_profiled
+
+def format_bytes(size):
+    """把字节数格式化为易读的字符串"""
+    if size < 1024:
+        return f"{size} B"
+    for unit in ('KB', 'MB'):
+        size /= 1024
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+    return f"{size / 1024:.1f} GB"
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="Remove upload files no memory references")
+    parser.add_argument('--data-dir', default="data", help="数据目录 (默认: data)")
+    parser.add_argument('--dry-run', action='store_true', help="只报告，不删除")
+    parser.add_argument('--min-age', type=float, default=24,
+                        help="只清理早于这么多小时的文件 (默认: %(default)s)")
+    args = parser.parse_args()
+
+    print("🧹 开始扫描孤立的上传文件...")
+    orphans = find_orphans(args.data_dir, min_age=args.min_age * 3600)
+
+    if not orphans:
+        print("✅ 没有孤立文件")
+    else:
+        total_bytes = sum(size for _, size in orphans)
+        for path, size in orphans:
+            print(f"  🗑️ {path} ({format_bytes(size)})")
+
+        if args.dry_run:
+            print(f"📊 [dry-run] 可回收 {len(orphans)} 个文件，共 {format_bytes(total_bytes)}")
+        else:
+            for path, _ in orphans:
+                os.remove(os.path.join(args.data_dir, path))
+            print(f"🎉 已删除 {len(orphans)} 个文件，回收 {format_bytes(total_bytes)}")
+
+    print(f"📅 时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+if __name__ == "__main__":
+    run_profiled(main)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Geometry helpers
+Shared line simplification, bounding box and distance helpers for trajectories
+"""
+
+import math
+
+def iter_lines(geometry):
+    """Yield each coordinate list of a LineString / MultiLineString geometry"""
+    if not isinstance(geometry, dict):
+        return
+    geometry_type = geometry.get('type')
+    coordinates = geometry.get('coordinates') or []
+    if geometry_type == 'LineString':
+        yield coordinates
+    elif geometry_type == 'MultiLineString':
+        for line in coordinates:
+            yield line
+
+def _perpendicular_distance(point, start, end):
+    """Distance from point to the segment start-end, in coordinate units"""
+    x, y = point[0], point[1]
+    x1, y1 = start[0], start[1]
+    x2, y2 = end[0], end[1]
+    dx = x2 - x1
+    dy = y2 - y1
+    if dx == 0 and dy == 0:
+        return ((x - x1) ** 2 + (y - y1) ** 2) ** 0.5
+
+    t = ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)
+    t = max(0.0, min(1.0, t))
+    px = x1 + t * dx
+    py = y1 + t * dy
+    return ((x - px) ** 2 + (y - py) ** 2) ** 0.5
+
+def simplify_line(coordinates, tolerance):
+    """
+    Douglas-Peucker simplification of a coordinate list.
+    Iterative so that long GPS tracks do not hit the recursion limit.
+    """
+    if tolerance <= 0 or len(coordinates) < 3:
+        return list(coordinates)
+
+    keep = [False] * len(coordinates)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(coordinates) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        max_distance = 0.0
+        index = first
+        for i in range(first + 1, last):
+            distance = _perpendicular_distance(coordinates[i], coordinates[first], coordinates[last])
+            if distance > max_distance:
+                max_distance = distance
+                index = i
+        if max_distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [point for point, kept in zip(coordinates, keep) if kept]
+
+def simplify_geometry(geometry, tolerance):
+    """Return a simplified copy of a LineString / MultiLineString geometry"""
+    if not isinstance(geometry, dict):
+        return geometry
+
+    geometry_type = geometry.get('type')
+    if geometry_type == 'LineString':
+        coordinates = simplify_line(geometry.get('coordinates') or [], tolerance)
+    elif geometry_type == 'MultiLineString':
+        coordinates = [simplify_line(line, tolerance) for line in geometry.get('coordinates') or []]
+    else:
+        return geometry
+
+    return {'type': geometry_type, 'coordinates': coordinates}
+
+def geometry_bbox(geometry):
+    """Bounding box [west, south, east, north] of a line geometry, or None if empty"""
+    west = south = float('inf')
+    east = north = float('-inf')
+    for line in iter_lines(geometry):
+        for point in line:
+            west = min(west, point[0])
+            east = max(east, point[0])
+            south = min(south, point[1])
+            north = max(north, point[1])
+    if west == float('inf'):
+        return None
+    return [west, south, east, north]
+
+EARTH_RADIUS_M = 6371008.8
+
+def haversine_length(coordinates):
+    """Length of a coordinate list in metres"""
+    length = 0.0
+    for start, end in zip(coordinates, coordinates[1:]):
+        lon1, lat1 = math.radians(start[0]), math.radians(start[1])
+        lon2, lat2 = math.radians(end[0]), math.radians(end[1])
+        a = (math.sin((lat2 - lat1) / 2) ** 2
+             + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+        length += 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+    return length
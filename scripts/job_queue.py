@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Background job queue
+Persistent SQLite-backed queue for work that should not hold up an HTTP request
+(recounts, indexing, derived files). Identical pending jobs are deduplicated,
+failed jobs are retried with exponential backoff, and queued jobs survive a restart.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2.0       # seconds before the first retry, doubled on each attempt
+BACKOFF_MAX = 300.0
+POLL_INTERVAL = 1.0
+KEEP_FINISHED = 7 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    dedup_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    last_error TEXT,
+    result TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending_dedup ON jobs (dedup_key) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after);
+CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, status);
+"""
+
+class JobQueue:
+    """Job queue with a pool of worker threads; handlers are registered per job kind"""
+
+    def __init__(self, db_path, workers=DEFAULT_WORKERS):
+        self.db_path = db_path
+        self.workers = workers
+        self._handlers = {}
+        self._threads = []
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Condition()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def register(self, kind, handler):
+        """handler(payload) runs in a worker thread; its return value is stored as the result"""
+        self._handlers[kind] = handler
+
+    # ------------------------------------------------------------------
+    # Producer side
+    # ------------------------------------------------------------------
+
+    def enqueue(self, kind, payload=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Queue a job and return its id; an identical pending job is reused instead"""
+        payload_text = json.dumps(payload or {}, sort_keys=True, ensure_ascii=False)
+        dedup_key = f"{kind}:{payload_text}"
+        now = time.time()
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE dedup_key = ? AND status = 'pending'", (dedup_key,)
+            ).fetchone()
+            if row is not None:
+                return row['id']
+            try:
+                cursor = self._conn.execute(
+                    "INSERT INTO jobs (kind, payload, dedup_key, status, max_attempts, run_after, created_at, updated_at) "
+                    "VALUES (?, ?, ?, 'pending', ?, ?, ?, ?)",
+                    (kind, payload_text, dedup_key, max_attempts, now, now, now)
+                )
+                job_id = cursor.lastrowid
+            except sqlite3.IntegrityError:
+                # Another process queued the same job between the check and the insert
+                return self._conn.execute(
+                    "SELECT id FROM jobs WHERE dedup_key = ? AND status = 'pending'", (dedup_key,)
+                ).fetchone()['id']
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def get(self, job_id):
+        """Job status as a dict, or None if unknown"""
+        with self._db_lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'payload': json.loads(row['payload']),
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'maxAttempts': row['max_attempts'],
+            'runAfter': row['run_after'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at'],
+            'lastError': row['last_error'],
+            'result': json.loads(row['result']) if row['result'] else None
+        }
+
+    def stats(self):
+        with self._db_lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {row['status']: row['n'] for row in rows}
+        return {'workers': len(self._threads), 'jobs': counts}
+
+    # ------------------------------------------------------------------
+    # Worker side
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Recover jobs interrupted by a restart and start the worker threads"""
+        now = time.time()
+        with self._db_lock:
+            # An interrupted job whose identical twin is already pending (or also interrupted, with a
+            # newer id) cannot go back to pending without breaking dedup; the twin does the same work
+            superseded = self._conn.execute(
+                "UPDATE jobs SET status = 'failed', last_error = ?, updated_at = ? "
+                "WHERE status = 'running' AND EXISTS ("
+                "  SELECT 1 FROM jobs AS twin WHERE twin.dedup_key = jobs.dedup_key AND ("
+                "    twin.status = 'pending' OR (twin.status = 'running' AND twin.id > jobs.id)))",
+                ("Interrupted by a restart (superseded by an identical queued job)", now)
+            ).rowcount
+            recovered = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', updated_at = ? WHERE status = 'running'", (now,)
+            ).rowcount
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (now - KEEP_FINISHED,)
+            )
+        if recovered or superseded:
+            logger.info(f"Recovered {recovered} interrupted jobs, dropped {superseded} superseded by identical jobs")
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stop_event.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _claim(self):
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # An identical job that is still running would race this one over the same output
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'pending' AND run_after <= ? AND NOT EXISTS ("
+                    "  SELECT 1 FROM jobs AS twin WHERE twin.dedup_key = jobs.dedup_key AND twin.status = 'running')"
+                    " ORDER BY run_after, id LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (now, row['id'])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def _finish(self, job, result=None, error=None):
+        now = time.time()
+        attempts = job['attempts'] + 1
+        with self._db_lock:
+            if error is None:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'done', result = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                    (json.dumps(result, ensure_ascii=False), now, job['id'])
+                )
+            elif attempts < job['max_attempts']:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+                try:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'pending', run_after = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                        (now + delay, error, now, job['id'])
+                    )
+                except sqlite3.IntegrityError:
+                    # An identical job was queued meanwhile; it will do the same work
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
+                        (f"{error} (superseded by a newer identical job)", now, job['id'])
+                    )
+                logger.warning(f"Job {job['id']} ({job['kind']}) failed, retrying in {delay:.1f}s: {error}")
+            else:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
+                    (error, now, job['id'])
+                )
+                logger.error(f"Job {job['id']} ({job['kind']}) failed after {attempts} attempts: {error}")
+
+    def _worker(self):
+        while not self._stop_event.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                logger.error(f"Job queue error: {e}")
+                job = None
+
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(POLL_INTERVAL)
+                continue
+
+            handler = self._handlers.get(job['kind'])
+            try:
+                if handler is None:
+                    raise KeyError(f"No handler registered for job kind '{job['kind']}'")
+                result = handler(json.loads(job['payload']))
+                self._finish(job, result=result)
+            except Exception as e:
+                self._finish(job, error=str(e))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Content-addressed media store
+Uploads are stored under the SHA-256 of their content so identical files are kept once.
+References are counted from the media arrays of the individual memory files.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+MEDIA_KINDS = ('images', 'trajectories')
+
+def sanitize_extension(extension, default):
+    """Keep only a short alphanumeric extension so it cannot escape the uploads directory"""
+    extension = re.sub(r'[^a-z0-9]', '', str(extension or '').lower())[:10]
+    return extension or default
+
+def store_blob(target_dir, data, extension):
+    """
+    Write bytes under their content hash and return (filename, created).
+    An existing file with the same hash is reused instead of written again; its mtime
+    is refreshed so garbage collection treats it as a new upload (see find_orphans).
+    """
+    filename = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+    file_path = os.path.join(target_dir, filename)
+    if os.path.exists(file_path):
+        try:
+            os.utime(file_path)
+            return filename, False
+        except FileNotFoundError:
+            pass  # collected between the check and the touch; write it again
+
+    os.makedirs(target_dir, exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+    return filename, True
+
+def memory_media_paths(memory):
+    """All upload paths (e.g. uploads/images/<hash>.png) referenced by one memory"""
+    media = memory.get('media') or {}
+    paths = []
+    for kind in MEDIA_KINDS:
+        for path in media.get(kind) or []:
+            # Inline base64 fallbacks are not files
+            if isinstance(path, str) and path.startswith('uploads/'):
+                paths.append(path)
+    return paths
+
+def collect_references(memories_dir):
+    """Map of upload path -> ids of the memories that reference it"""
+    references = {}
+    for memory_file in glob.glob(os.path.join(memories_dir, "*.json")):
+        if os.path.basename(memory_file).startswith('memories-'):
+            continue
+        with open(memory_file, 'r', encoding='utf-8') as f:
+            memory = json.load(f)
+        for path in memory_media_paths(memory):
+            references.setdefault(path, set()).add(memory.get('id'))
+    return references
+
+def find_orphans(data_dir, min_age=0):
+    """
+    Upload files no memory references, as a list of (path, size).
+    Files younger than min_age seconds are skipped: they may belong to a
+    memory whose save has not reached the server yet.
+    """
+    references = collect_references(os.path.join(data_dir, "memories"))
+    now = time.time()
+    orphans = []
+    for kind in MEDIA_KINDS:
+        kind_dir = os.path.join(data_dir, "uploads", kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for entry in os.scandir(kind_dir):
+            if not entry.is_file() or entry.name.startswith('.') or entry.name.endswith('.tmp'):
+                continue
+            path = f"uploads/{kind}/{entry.name}"
+            if path in references:
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime < min_age:
+                continue
+            orphans.append((path, stat.st_size))
+    return sorted(orphans)
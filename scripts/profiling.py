@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - On-demand profiling
+Profiles a chosen fraction of server requests per route, or a whole maintenance script run.
+
+  UAL_M2_PROFILE=sample|full|off      sample: collapsed stacks for flame graphs (flamegraph.pl, speedscope)
+                                      full:   cProfile .pstats files (snakeviz, gprof2dot, flameprof)
+  UAL_M2_PROFILE_RATE=0.1             fraction of requests to profile, or per route:
+                                      "/api/memories/list=1,/api/users/{id}=0.2,*=0.01"
+  UAL_M2_PROFILE_DIR=data/profiles    output directory
+"""
+
+import cProfile
+import functools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+MODES = ('off', 'sample', 'full')
+DEFAULT_PROFILE_DIR = os.path.join("data", "profiles")
+SAMPLE_INTERVAL = 0.001  # seconds between stack samples
+
+ROUTE_PATTERNS = [
+    (re.compile(r'^/tiles/\d+/\d+/\d+'), '/tiles/{z}/{x}/{y}'),
+    (re.compile(r'^/api/(users|memories|jobs)/(?!list$|save$|save-all$|search$)[^/]+$'), r'/api/\1/{id}'),
+]
+
+def route_key(path):
+    """Collapse ids in a request path so that rates and output files are per route"""
+    path = urlparse(path).path
+    for pattern, replacement in ROUTE_PATTERNS:
+        if pattern.match(path):
+            return pattern.sub(replacement, path)
+    return path
+
+def parse_rates(text):
+    """Parse "0.1" or "route=rate,...,*=rate" into a {route: rate} dict"""
+    rates = {}
+    for part in str(text or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        route, _, rate = part.rpartition('=')
+        rates[route or '*'] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of one thread and counts collapsed stacks"""
+
+    def __init__(self, target_ident, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.counts = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_ident)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+class Profiler:
+    """Decides which requests to profile and writes the results"""
+
+    def __init__(self, mode='off', rates=None, output_dir=DEFAULT_PROFILE_DIR):
+        self.output_dir = output_dir
+        self.profiled = Counter()
+        self.skipped_busy = 0
+        # cProfile cannot run in two threads at once, so full profiles are serialized
+        self._full_lock = threading.Lock()
+        self.configure(mode, rates if rates is not None else {'*': 1.0})
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            mode=os.environ.get('UAL_M2_PROFILE', 'off') or 'off',
+            rates=parse_rates(os.environ.get('UAL_M2_PROFILE_RATE', '1')),
+            output_dir=os.environ.get('UAL_M2_PROFILE_DIR', DEFAULT_PROFILE_DIR)
+        )
+
+    def configure(self, mode, rates=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode: {mode} (expected one of {', '.join(MODES)})")
+        self.mode = mode
+        if rates is not None:
+            self.rates = dict(rates)
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def rate_for(self, route):
+        return self.rates.get(route, self.rates.get('*', 0.0))
+
+    def _output_path(self, name, extension):
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_') or 'root'
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.output_dir, f"{stamp}-{int(time.time() * 1000) % 1000:03d}-{slug}.{extension}")
+
+    def run(self, name, func, *args, **kwargs):
+        """Call func under the configured profiler and write the result named after name"""
+        if self.mode == 'sample':
+            sampler = _StackSampler(threading.get_ident())
+            sampler.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                sampler.stop()
+                self._write_collapsed(name, sampler.counts)
+
+        if self.mode == 'full':
+            if not self._full_lock.acquire(blocking=False):
+                self.skipped_busy += 1
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                profile.dump_stats(self._output_path(name, 'pstats'))
+                self._full_lock.release()
+
+        return func(*args, **kwargs)
+
+    def _write_collapsed(self, name, counts):
+        if not counts:
+            return
+        with open(self._output_path(name, 'collapsed'), 'w', encoding='utf-8') as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def maybe_run(self, method, path, func, *args, **kwargs):
+        """Profile a request with the probability configured for its route"""
+        if not self.enabled:
+            return func(*args, **kwargs)
+        route = route_key(path)
+        if random.random() >= self.rate_for(route):
+            return func(*args, **kwargs)
+        self.profiled[f"{method} {route}"] += 1
+        return self.run(f"{method} {route}", func, *args, **kwargs)
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'rates': self.rates,
+            'outputDir': self.output_dir,
+            'profiled': dict(self.profiled),
+            'skippedBusy': self.skipped_busy
+        }
+
+def profiled_request(method):
+    """Decorator for do_GET / do_POST that hands the request to the server's profiler"""
+    @functools.wraps(method)
+    def wrapper(handler):
+        profiler = getattr(handler.server, 'profiler', None)
+        if profiler is None:
+            return method(handler)
+        return profiler.maybe_run(handler.command, handler.path, method, handler)
+    return wrapper
+
+def run_profiled(main):
+    """
+    Entry point for maintenance scripts: runs main() under the profiler when
+    UAL_M2_PROFILE is set, so full-dataset passes can be profiled too.
+    """
+    profiler = Profiler.from_env()
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    result = profiler.run(script, main) if profiler.enabled else main()
+    if profiler.enabled:
+        print(f"🔬 Profile written to {os.path.abspath(profiler.output_dir)}")
+    return result
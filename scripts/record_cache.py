@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Record cache
+Bounded LRU cache of parsed and pre-serialized user / memory records.
+The budget is in bytes, not entries, because memory records vary a lot in size.
+"""
+
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+def estimate_size(value):
+    """Rough in-memory size of a parsed JSON value, in bytes"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sys.getsizeof(key) + estimate_size(item)
+    elif isinstance(value, list):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+class RecordCache:
+    """Thread-safe LRU mapping (kind, id) -> (record, serialized body)"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        # Bumped by every invalidation, so a read that raced a write is not cached
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, kind, record_id):
+        """Return (record, body) or None, counting the hit or miss"""
+        key = (kind, record_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def generation(self, kind, record_id):
+        """Token to take before reading a record from disk and hand back to put()"""
+        with self._lock:
+            return self._generations.get((kind, record_id), 0)
+
+    def put(self, kind, record_id, record, body, generation=None):
+        """
+        Cache a record; records larger than the whole budget are not cached.
+        With a generation from generation(), the record is dropped if it was
+        invalidated since, because the copy read from disk may predate the write.
+        """
+        size = len(body) + estimate_size(record)
+        if size > self.max_bytes:
+            return
+        key = (kind, record_id)
+        with self._lock:
+            if generation is not None and self._generations.get(key, 0) != generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[2]
+            self._entries[key] = (record, body, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted[2]
+                self.evictions += 1
+
+    def invalidate(self, kind, record_id):
+        """Drop a record after it has been written"""
+        with self._lock:
+            self._generations[(kind, record_id)] = self._generations.get((kind, record_id), 0) + 1
+            entry = self._entries.pop((kind, record_id), None)
+            if entry is not None:
+                self.current_bytes -= entry[2]
+                self.invalidations += 1
+
+    def export_state(self):
+        """Packed (kind, id, record, body) entries, least recently used first"""
+        with self._lock:
+            entries = [(kind, record_id, record, body) for (kind, record_id), (record, body, _) in self._entries.items()]
+            return pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def restore_state(self, data):
+        """Warm the cache with entries from export_state (the byte budget still applies)"""
+        for kind, record_id, record, body in pickle.loads(data):
+            self.put(kind, record_id, record, body)
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
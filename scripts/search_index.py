@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Full-text search over memories
+In-memory inverted index of memory titles, descriptions and contributor names.
+English text is split into words; Chinese (CJK) text into single characters and bigrams.
+"""
+
+import math
+import pickle
+import re
+import threading
+
+# Field weights: a hit in the title counts more than one in the description
+FIELD_WEIGHTS = {
+    'title': 3.0,
+    'contributorName': 2.0,
+    'description': 1.0
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+|[㐀-䶿一-鿿豈-﫿]+')
+CJK_PATTERN = re.compile(r'[㐀-䶿一-鿿豈-﫿]')
+
+def _cjk_tokens(run, with_unigrams):
+    tokens = []
+    if with_unigrams or len(run) == 1:
+        tokens.extend(run)
+    tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+def tokenize(text, for_query=False):
+    """
+    Split text into index tokens.
+    Documents index CJK characters and bigrams; queries use bigrams only
+    (unigrams for single characters) so multi-character words match precisely.
+    """
+    tokens = []
+    for run in TOKEN_PATTERN.findall(str(text or '').lower()):
+        if CJK_PATTERN.match(run):
+            tokens.extend(_cjk_tokens(run, with_unigrams=not for_query))
+        else:
+            tokens.append(run)
+    return tokens
+
+class SearchIndex:
+    """Thread-safe BM25 inverted index keyed by memory id"""
+
+    def __init__(self):
+        self._postings = {}      # token -> {memory_id: weighted term frequency}
+        self._doc_tokens = {}    # memory_id -> set of tokens, for removal
+        self._doc_lengths = {}   # memory_id -> weighted length
+        self._docs = {}          # memory_id -> summary returned with results
+        self._total_length = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, memory):
+        """Index a memory, replacing any previous version with the same id"""
+        memory_id = memory.get('id')
+        if memory_id is None:
+            return
+
+        frequencies = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(memory.get(field)):
+                frequencies[token] = frequencies.get(token, 0.0) + weight
+
+        with self._lock:
+            self._remove_locked(memory_id)
+            for token, frequency in frequencies.items():
+                self._postings.setdefault(token, {})[memory_id] = frequency
+            length = sum(frequencies.values())
+            self._doc_tokens[memory_id] = set(frequencies)
+            self._doc_lengths[memory_id] = length
+            self._total_length += length
+            self._docs[memory_id] = {
+                'id': memory_id,
+                'title': memory.get('title', ''),
+                'contributorName': memory.get('contributorName', ''),
+                'targetUserId': memory.get('targetUserId'),
+                'timestamp': memory.get('timestamp')
+            }
+
+    def export_state(self):
+        """Packed copy of the index for the startup snapshot"""
+        with self._lock:
+            return pickle.dumps((self._postings, self._doc_tokens, self._doc_lengths, self._docs,
+                                 self._total_length), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def restore_state(self, data):
+        """Replace the index with one exported by export_state"""
+        state = pickle.loads(data)
+        with self._lock:
+            self._postings, self._doc_tokens, self._doc_lengths, self._docs, self._total_length = state
+        return len(self)
+
+    def remove(self, memory_id):
+        with self._lock:
+            self._remove_locked(memory_id)
+
+    def _remove_locked(self, memory_id):
+        for token in self._doc_tokens.pop(memory_id, ()):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(memory_id, None)
+                if not postings:
+                    del self._postings[token]
+        self._total_length -= self._doc_lengths.pop(memory_id, 0.0)
+        self._docs.pop(memory_id, None)
+
+    def search(self, query, offset=0, limit=20):
+        """Return (total, results) ranked by BM25 score, newest first on ties"""
+        tokens = set(tokenize(query, for_query=True))
+        if not tokens:
+            return 0, []
+
+        with self._lock:
+            doc_count = len(self._docs)
+            if doc_count == 0:
+                return 0, []
+            average_length = self._total_length / doc_count
+
+            scores = {}
+            for token in tokens:
+                postings = self._postings.get(token)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for memory_id, frequency in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._doc_lengths[memory_id] / average_length)
+                    score = idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+                    scores[memory_id] = scores.get(memory_id, 0.0) + score
+
+            # Newest first among equal scores (both sorts are stable)
+            ranked = sorted(scores.items(), key=lambda item: str(self._docs[item[0]].get('timestamp') or ''),
+                            reverse=True)
+            ranked.sort(key=lambda item: -item[1])
+
+            page = [
+                dict(self._docs[memory_id], score=round(score, 4))
+                for memory_id, score in ranked[offset:offset + limit]
+            ]
+            return len(ranked), page
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Startup snapshot of the server's in-memory state
+The server packs its indexes and warm caches, the change feed position and the
+size/mtime of every record file into one versioned file. On boot it loads the snapshot
+and re-reads only the record files that changed since, instead of parsing all of them.
+
+  UAL_M2_SNAPSHOT_INTERVAL=300    seconds between periodic snapshots and checks for record files
+                                  edited outside the server (0 = only on shutdown)
+"""
+
+import logging
+import os
+import pickle
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_MAGIC = b'UALM2SNAP'
+DEFAULT_INTERVAL = 300
+
+# Record directories and the prefix of the consolidated snapshot files kept next to the records
+RECORD_DIRS = {
+    'users': 'contributors-',
+    'memories': 'memories-'
+}
+
+def snapshot_path(data_dir):
+    return os.path.join(data_dir, "cache", "state.snapshot")
+
+def scan_record_files(data_dir):
+    """{(kind, record_id): (mtime_ns, size)} for every individual record file (stat only, no parsing)"""
+    files = {}
+    for kind, summary_prefix in RECORD_DIRS.items():
+        records_dir = os.path.join(data_dir, kind)
+        if not os.path.isdir(records_dir):
+            continue
+        with os.scandir(records_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json') or entry.name.startswith(summary_prefix):
+                    continue
+                stat = entry.stat()
+                files[(kind, entry.name[:-len('.json')])] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+def record_file_signature(data_dir, kind, record_id):
+    """(mtime_ns, size) of one record file as scan_record_files reports it, or None if it is gone"""
+    try:
+        stat = os.stat(os.path.join(data_dir, kind, f"{record_id}.json"))
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def diff_record_files(old_files, new_files):
+    """(changed, removed) lists of (kind, record_id) between two scans"""
+    changed = [key for key, signature in new_files.items() if old_files.get(key) != signature]
+    removed = [key for key in old_files if key not in new_files]
+    return changed, removed
+
+def load_snapshot(path):
+    """The snapshot dict, or None if it is missing, damaged or from another version"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                logger.warning(f"Ignoring {path}: not a state snapshot")
+                return None
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable state snapshot {path}: {e}")
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        logger.info(f"Ignoring state snapshot {path} from another version")
+        return None
+    return snapshot
+
+def write_snapshot(path, seq, files, sections, feed=None):
+    """
+    Atomically write a snapshot. sections maps a name to the packed state of one
+    component (bytes from its export_state); files is the scan the state reflects;
+    feed is the change feed position() at seq.
+    """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'createdAt': time.time(),
+        'seq': seq,
+        'feed': feed,
+        'files': files,
+        'sections': sections
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Do not leave a partial snapshot behind, whether the write failed or was interrupted
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return os.path.getsize(path)
+
+class SnapshotWriter:
+    """Calls write() every interval seconds in a daemon thread, and write(force=True) on stop()"""
+
+    def __init__(self, write, interval=DEFAULT_INTERVAL):
+        self.write = write
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._write_logged()
+
+    def _write_logged(self, force=False):
+        try:
+            self.write(force=force)
+        except Exception as e:
+            logger.error(f"Failed to write state snapshot: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._write_logged(force=True)
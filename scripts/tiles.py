@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Map tiles for memories and trajectories
+Builds clipped, zoom-simplified GeoJSON (or Mapbox Vector) tiles with an on-disk cache
+"""
+
+import glob
+import json
+import math
+import os
+import shutil
+import threading
+import logging
+from contextlib import nullcontext
+
+from geo_utils import iter_lines, simplify_line, geometry_bbox
+
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+logger = logging.getLogger(__name__)
+
+MAX_ZOOM = 22
+CLUSTER_MAX_ZOOM = 13      # point memories are clustered below this zoom
+CLUSTER_GRID = 8           # cluster cells per tile side
+TILE_BUFFER = 1 / 16       # fraction of a tile kept around the edges to avoid seams
+MVT_EXTENT = 4096
+
+def lnglat_to_tile(lng, lat, z):
+    """Fractional tile coordinates of a point at zoom z"""
+    lat = max(-85.05112878, min(85.05112878, lat))
+    n = 2 ** z
+    x = (lng + 180.0) / 360.0 * n
+    lat_rad = math.radians(lat)
+    y = (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n
+    return x, y
+
+def tile_bounds(z, x, y):
+    """Bounding box [west, south, east, north] of a tile"""
+    n = 2 ** z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return [west, south, east, north]
+
+def tile_range(bbox, z):
+    """Inclusive x and y tile ranges covering a bbox at zoom z"""
+    n = 2 ** z
+    x0, y0 = lnglat_to_tile(bbox[0], bbox[3], z)
+    x1, y1 = lnglat_to_tile(bbox[2], bbox[1], z)
+
+    def clamp(v):
+        return max(0, min(n - 1, int(math.floor(v))))
+
+    return (clamp(x0), clamp(x1)), (clamp(y0), clamp(y1))
+
+def _buffered(bounds):
+    west, south, east, north = bounds
+    dx = (east - west) * TILE_BUFFER
+    dy = (north - south) * TILE_BUFFER
+    return [west - dx, south - dy, east + dx, north + dy]
+
+def _intersects(a, b):
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+def _contains(bounds, point):
+    return bounds[0] <= point[0] <= bounds[2] and bounds[1] <= point[1] <= bounds[3]
+
+def clip_line(coordinates, bounds):
+    """
+    Split a line into the runs of segments that touch the bounds.
+    Segments are kept whole; the tile buffer hides the overhang.
+    """
+    runs = []
+    current = []
+    for start, end in zip(coordinates, coordinates[1:]):
+        segment_bbox = [min(start[0], end[0]), min(start[1], end[1]),
+                        max(start[0], end[0]), max(start[1], end[1])]
+        if _intersects(segment_bbox, bounds):
+            if not current:
+                current.append(start)
+            current.append(end)
+        elif current:
+            runs.append(current)
+            current = []
+    if current:
+        runs.append(current)
+    return runs
+
+def zoom_tolerance(z):
+    """Simplification tolerance in degrees, roughly half a pixel at zoom z"""
+    return 360.0 / (2 ** z) / 512.0
+
+class TileCache:
+    """
+    Builds tiles from the memory files and caches them under cache_dir/{z}/{x}/{y}.{ext}
+
+    A tile is only written to disk if nothing was invalidated while it was built.
+    When several processes share cache_dir, write_lock (a context manager factory
+    also held around record writes) and external_generation (a callable whose value
+    changes with every write by any process) extend that check across processes.
+    """
+
+    def __init__(self, data_dir, cache_dir=None, write_lock=None, external_generation=None):
+        self.data_dir = data_dir
+        self.memories_dir = os.path.join(data_dir, "memories")
+        self.cache_dir = cache_dir or os.path.join(data_dir, "cache", "tiles")
+        self.write_lock = write_lock or nullcontext
+        self.external_generation = external_generation
+        self._features = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def mvt_available(self):
+        return mapbox_vector_tile is not None
+
+    # ------------------------------------------------------------------
+    # Source features
+    # ------------------------------------------------------------------
+
+    def _load_trajectories(self, memory):
+        geometries = []
+        if memory.get('trajectory'):
+            geometries.append(memory['trajectory'])
+        media = memory.get('media') or {}
+        for trajectory_path in media.get('trajectories') or []:
+            trajectory_file = os.path.join(self.data_dir, trajectory_path)
+            if os.path.exists(trajectory_file):
+                with open(trajectory_file, 'r', encoding='utf-8') as f:
+                    geometries.append(json.load(f))
+        return geometries
+
+    def memory_bboxes(self, memory):
+        """Bounding boxes a memory draws into: its marker and each trajectory"""
+        bboxes = []
+        coordinates = memory.get('coordinates')
+        if coordinates and len(coordinates) >= 2:
+            bboxes.append([coordinates[0], coordinates[1], coordinates[0], coordinates[1]])
+        for geometry in self._load_trajectories(memory):
+            bbox = geometry_bbox(geometry)
+            if bbox:
+                bboxes.append(bbox)
+        return bboxes
+
+    def _get_features(self):
+        with self._lock:
+            if self._features is not None:
+                return self._features
+
+            points = []
+            lines = []
+            for memory_file in glob.glob(os.path.join(self.memories_dir, "*.json")):
+                if os.path.basename(memory_file).startswith('memories-'):
+                    continue
+                with open(memory_file, 'r', encoding='utf-8') as f:
+                    memory = json.load(f)
+
+                properties = {
+                    'id': memory.get('id'),
+                    'title': memory.get('title', ''),
+                    'targetUserId': memory.get('targetUserId'),
+                    'contributorColor': memory.get('contributorColor', '#888')
+                }
+                coordinates = memory.get('coordinates')
+                if coordinates and len(coordinates) >= 2:
+                    points.append((coordinates, properties))
+                for geometry in self._load_trajectories(memory):
+                    bbox = geometry_bbox(geometry)
+                    if bbox:
+                        lines.append((list(iter_lines(geometry)), bbox, properties))
+
+            self._features = (points, lines)
+            return self._features
+
+    # ------------------------------------------------------------------
+    # Tile building
+    # ------------------------------------------------------------------
+
+    def _cluster_points(self, points, z, x, y):
+        cells = {}
+        for coordinates, properties in points:
+            tx, ty = lnglat_to_tile(coordinates[0], coordinates[1], z)
+            cell = (int((tx - x) * CLUSTER_GRID), int((ty - y) * CLUSTER_GRID))
+            cells.setdefault(cell, []).append((coordinates, properties))
+
+        features = []
+        for members in cells.values():
+            if len(members) == 1:
+                coordinates, properties = members[0]
+                features.append(self._point_feature(coordinates, properties))
+                continue
+            lng = sum(c[0] for c, _ in members) / len(members)
+            lat = sum(c[1] for c, _ in members) / len(members)
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+                'properties': {
+                    'cluster': True,
+                    'point_count': len(members),
+                    'ids': [p['id'] for _, p in members]
+                }
+            })
+        return features
+
+    @staticmethod
+    def _point_feature(coordinates, properties):
+        return {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [coordinates[0], coordinates[1]]},
+            'properties': dict(properties, kind='memory')
+        }
+
+    def build_features(self, z, x, y):
+        """Clipped, simplified and (at low zoom) clustered features of one tile"""
+        points, lines = self._get_features()
+        bounds = tile_bounds(z, x, y)
+        clip_bounds = _buffered(bounds)
+
+        tile_points = [(c, p) for c, p in points if _contains(bounds, c)]
+        if z < CLUSTER_MAX_ZOOM:
+            features = self._cluster_points(tile_points, z, x, y)
+        else:
+            features = [self._point_feature(c, p) for c, p in tile_points]
+
+        tolerance = zoom_tolerance(z)
+        for line_list, bbox, properties in lines:
+            if not _intersects(bbox, clip_bounds):
+                continue
+            parts = []
+            for line in line_list:
+                for run in clip_line(line, clip_bounds):
+                    simplified = simplify_line(run, tolerance)
+                    if len(simplified) >= 2:
+                        parts.append(simplified)
+            if not parts:
+                continue
+            if len(parts) == 1:
+                geometry = {'type': 'LineString', 'coordinates': parts[0]}
+            else:
+                geometry = {'type': 'MultiLineString', 'coordinates': parts}
+            features.append({
+                'type': 'Feature',
+                'geometry': geometry,
+                'properties': dict(properties, kind='trajectory')
+            })
+
+        return features
+
+    def _encode_mvt(self, features, z, x, y):
+        def to_tile_pixels(point):
+            tx, ty = lnglat_to_tile(point[0], point[1], z)
+            return '%d %d' % (round((tx - x) * MVT_EXTENT), round((ty - y) * MVT_EXTENT))
+
+        layers = {'memories': [], 'trajectories': []}
+        for feature in features:
+            geometry = feature['geometry']
+            properties = {
+                k: (json.dumps(v) if isinstance(v, list) else v)
+                for k, v in feature['properties'].items() if v is not None
+            }
+            if geometry['type'] == 'Point':
+                wkt = 'POINT (%s)' % to_tile_pixels(geometry['coordinates'])
+                layers['memories'].append({'geometry': wkt, 'properties': properties})
+            else:
+                parts = list(iter_lines(geometry))
+                wkt = 'MULTILINESTRING (%s)' % ', '.join(
+                    '(%s)' % ', '.join(to_tile_pixels(p) for p in part) for part in parts
+                )
+                layers['trajectories'].append({'geometry': wkt, 'properties': properties})
+
+        layer_list = [{'name': name, 'features': feats} for name, feats in layers.items()]
+        try:
+            return mapbox_vector_tile.encode(layer_list, default_options={'y_coord_down': True, 'extents': MVT_EXTENT})
+        except TypeError:
+            # mapbox-vector-tile < 2.0 takes the options as keyword arguments
+            return mapbox_vector_tile.encode(layer_list, y_coord_down=True, extents=MVT_EXTENT)
+
+    def get_tile(self, z, x, y, fmt='geojson'):
+        """Return the encoded tile, building and caching it on a miss"""
+        if not (0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"Invalid tile {z}/{x}/{y}")
+        if fmt == 'mvt' and not self.mvt_available:
+            raise ValueError("Vector tile encoder (mapbox_vector_tile) is not installed")
+
+        tile_file = os.path.join(self.cache_dir, str(z), str(x), f"{y}.{fmt}")
+        if os.path.exists(tile_file):
+            with open(tile_file, 'rb') as f:
+                return f.read()
+
+        generation = self._current_generation()
+        features = self.build_features(z, x, y)
+        if fmt == 'mvt':
+            body = self._encode_mvt(features, z, x, y)
+        else:
+            body = json.dumps({'type': 'FeatureCollection', 'features': features},
+                              ensure_ascii=False).encode('utf-8')
+
+        # Holding both locks, an invalidation either has not started (and will remove this
+        # tile) or has already changed the generation (and this possibly stale tile is not kept)
+        with self.write_lock(), self._lock:
+            if self._current_generation_locked() != generation:
+                return body
+            os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+            tmp_file = f"{tile_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_file, tile_file)
+        return body
+
+    def _current_generation(self):
+        with self._lock:
+            return self._current_generation_locked()
+
+    def _current_generation_locked(self):
+        external = self.external_generation() if self.external_generation is not None else None
+        return self._generation, external
+
+    # ------------------------------------------------------------------
+    # Invalidation
+    # ------------------------------------------------------------------
+
+    def invalidate(self, bboxes):
+        """Drop cached tiles that intersect any of the given bounding boxes"""
+        if not bboxes:
+            return 0
+        with self._lock:
+            self._features = None
+            self._generation += 1
+        if not os.path.isdir(self.cache_dir):
+            return 0
+
+        removed = 0
+        for z_name in os.listdir(self.cache_dir):
+            if not z_name.isdigit():
+                continue
+            z = int(z_name)
+            z_dir = os.path.join(self.cache_dir, z_name)
+            # Expand by the tile buffer so neighbouring tiles that draw the overhang are dropped too
+            ranges = []
+            for bbox in bboxes:
+                (x0, x1), (y0, y1) = tile_range(bbox, z)
+                ranges.append((x0 - 1, x1 + 1, y0 - 1, y1 + 1))
+
+            for x_name in os.listdir(z_dir):
+                if not x_name.isdigit():
+                    continue
+                x = int(x_name)
+                x_dir = os.path.join(z_dir, x_name)
+                y_ranges = [(y0, y1) for x0, x1, y0, y1 in ranges if x0 <= x <= x1]
+                if not y_ranges:
+                    continue
+                for tile_name in os.listdir(x_dir):
+                    y_name = tile_name.split('.', 1)[0]
+                    if y_name.isdigit() and any(y0 <= int(y_name) <= y1 for y0, y1 in y_ranges):
+                        os.remove(os.path.join(x_dir, tile_name))
+                        removed += 1
+
+        logger.info(f"Invalidated {removed} cached tiles")
+        return removed
+
+    def reset(self):
+        """Forget the in-memory features so they are reloaded (memories changed in another process)"""
+        with self._lock:
+            self._features = None
+            self._generation += 1
+
+    def clear(self):
+        """Drop the whole tile cache"""
+        with self._lock:
+            self._features = None
+            self._generation += 1
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
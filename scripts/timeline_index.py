@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Timeline index of memories
+Memories sorted by creation time, overall and per target user, with per-day/week/month
+counts kept up to date on every add and remove, so time-range slices and activity
+histograms are answered without looking at the memory records. Buckets are in UTC.
+"""
+
+import bisect
+import pickle
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+GRANULARITIES = ('day', 'week', 'month')
+
+# Year or year-month alone, which fromisoformat does not accept
+PARTIAL_DATE = re.compile(r'^(\d{4})(?:-(\d{2}))?$')
+
+def parse_time(value):
+    """
+    Seconds since the epoch, or None. Numbers are taken as epoch seconds; strings must be
+    ISO 8601, where a bare year (2024) or year-month (2024-05) means the start of it.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    partial = PARTIAL_DATE.match(text)
+    if partial:
+        try:
+            return datetime(int(partial.group(1)), int(partial.group(2) or 1), 1, tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            return None
+    try:
+        moment = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+def bucket_key(seconds, granularity):
+    """Histogram bucket of a time: 2024-05-03, 2024-W18 (ISO week) or 2024-05"""
+    moment = datetime.fromtimestamp(seconds, tz=timezone.utc)
+    if granularity == 'day':
+        return moment.strftime('%Y-%m-%d')
+    if granularity == 'week':
+        year, week, _ = moment.isocalendar()
+        return f"{year}-W{week:02d}"
+    if granularity == 'month':
+        return moment.strftime('%Y-%m')
+    raise ValueError(f"Unknown granularity: {granularity} (expected one of {', '.join(GRANULARITIES)})")
+
+class TimelineIndex:
+    """Thread-safe time-ordered index of memories keyed by memory id"""
+
+    def __init__(self):
+        self._entries = {None: []}   # target user (None = everyone) -> sorted [(time, memory_id)]
+        self._histograms = {g: {None: Counter()} for g in GRANULARITIES}  # granularity -> user -> Counter
+        self._docs = {}              # memory_id -> (time, target user, summary returned with results)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, memory):
+        """Index a memory by its timestamp, replacing any previous version; undated memories are skipped"""
+        memory_id = memory.get('id')
+        if memory_id is None:
+            return
+        seconds = parse_time(memory.get('timestamp'))
+        if seconds is not None:
+            try:
+                buckets = {granularity: bucket_key(seconds, granularity) for granularity in GRANULARITIES}
+            except (ValueError, OverflowError, OSError):
+                # Millisecond epochs, NaN and other times datetime cannot represent count as undated
+                seconds = None
+
+        with self._lock:
+            self._remove_locked(memory_id)
+            if seconds is None:
+                return
+            user = memory.get('targetUserId')
+            entry = (seconds, memory_id)
+            for key in (None, user) if user is not None else (None,):
+                bisect.insort(self._entries.setdefault(key, []), entry)
+                for granularity, histograms in self._histograms.items():
+                    histograms.setdefault(key, Counter())[buckets[granularity]] += 1
+            self._docs[memory_id] = (seconds, user, {
+                'id': memory_id,
+                'title': memory.get('title', ''),
+                'contributorName': memory.get('contributorName', ''),
+                'targetUserId': user,
+                'timestamp': memory.get('timestamp')
+            })
+
+    def remove(self, memory_id):
+        with self._lock:
+            self._remove_locked(memory_id)
+
+    def _remove_locked(self, memory_id):
+        doc = self._docs.pop(memory_id, None)
+        if doc is None:
+            return
+        seconds, user = doc[0], doc[1]
+        entry = (seconds, memory_id)
+        for key in (None, user) if user is not None else (None,):
+            entries = self._entries[key]
+            del entries[bisect.bisect_left(entries, entry)]
+            if not entries and key is not None:
+                del self._entries[key]
+            for granularity, histograms in self._histograms.items():
+                counts = histograms[key]
+                bucket = bucket_key(seconds, granularity)
+                counts[bucket] -= 1
+                if counts[bucket] <= 0:
+                    del counts[bucket]
+                if not counts and key is not None:
+                    del histograms[key]
+
+    def query(self, start=None, end=None, user=None, offset=0, limit=100, descending=False):
+        """(total, memories) with start <= time < end for everyone or one target user, in time order"""
+        with self._lock:
+            entries = self._entries.get(user, [])
+            low = bisect.bisect_left(entries, (start,)) if start is not None else 0
+            high = bisect.bisect_left(entries, (end,)) if end is not None else len(entries)
+            high = max(low, high)
+            if descending:
+                selected = entries[max(low, high - offset - limit):max(low, high - offset)][::-1]
+            else:
+                selected = entries[low + offset:min(high, low + offset + limit)]
+            return high - low, [self._docs[memory_id][2] for _, memory_id in selected]
+
+    def histogram(self, granularity='month', user=None, start=None, end=None):
+        """[{bucket, count}] in time order; buckets overlapping [start, end) are included whole"""
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity: {granularity} (expected one of {', '.join(GRANULARITIES)})")
+        first = bucket_key(start, granularity) if start is not None else None
+        # end is exclusive, so its own bucket only counts if end is not exactly on its boundary
+        last = bucket_key(end - 1e-6, granularity) if end is not None else None
+        with self._lock:
+            counts = list(self._histograms[granularity].get(user, {}).items())
+        return [
+            {'bucket': bucket, 'count': count} for bucket, count in sorted(counts)
+            if (first is None or bucket >= first) and (last is None or bucket <= last)
+        ]
+
+    def export_state(self):
+        """Packed copy of the index for the startup snapshot"""
+        with self._lock:
+            return pickle.dumps((self._entries, self._histograms, self._docs), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def restore_state(self, data):
+        """Replace the index with one exported by export_state"""
+        state = pickle.loads(data)
+        with self._lock:
+            self._entries, self._histograms, self._docs = state
+        return len(self)
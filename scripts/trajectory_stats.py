@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+UAL M2 - Trajectory statistics sidecar index
+Computes length, duration, bounding box and point count of every trajectory under
+uploads/trajectories and stores them in a compact columnar index under cache/, so the
+server can answer bbox / length queries without opening the trajectory files.
+
+Usage: python3 scripts/trajectory_stats.py [--data-dir data] [--workers N] [--rebuild]
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from geo_utils import EARTH_RADIUS_M, geometry_bbox, haversine_length, iter_lines
+from profiling import run_profiled
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+INDEX_FILE = "trajectory_index.json"
+
+def index_path(data_dir):
+    return os.path.join(data_dir, "cache", INDEX_FILE)
+FIELDS = ['length_m', 'duration_s', 'west', 'south', 'east', 'north', 'points', 'mtime_ns', 'size']
+
+def _line_length(coordinates):
+    """Haversine length of one line in metres, vectorized when NumPy is available"""
+    if len(coordinates) < 2:
+        return 0.0
+    if np is None:
+        return haversine_length(coordinates)
+
+    points = np.radians(np.asarray([point[:2] for point in coordinates], dtype=np.float64))
+    lon, lat = points[:, 0], points[:, 1]
+    a = (np.sin(np.diff(lat) / 2) ** 2
+         + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2)
+    return float(2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0))).sum())
+
+def _parse_time(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+def _duration(geometry):
+    """
+    Seconds between the first and last timestamp, or None without timing data.
+    Times come from a coordTimes / times array (GPX, togeojson) or a 4th coordinate.
+    """
+    times = geometry.get('coordTimes') or geometry.get('times') or []
+    if times and isinstance(times[0], list):
+        times = [t for line in times for t in line]
+    if not times:
+        times = [point[3] for line in iter_lines(geometry) for point in line if len(point) > 3]
+
+    parsed = [t for t in (_parse_time(value) for value in times) if t is not None]
+    if len(parsed) < 2:
+        return None
+    return max(parsed) - min(parsed)
+
+def compute_stats(trajectory_file):
+    """Statistics row (see FIELDS) of one trajectory file, or None if it has no line"""
+    stat = os.stat(trajectory_file)
+    with open(trajectory_file, 'r', encoding='utf-8') as f:
+        geometry = json.load(f)
+
+    bbox = geometry_bbox(geometry)
+    if bbox is None:
+        return None
+
+    lines = list(iter_lines(geometry))
+    length = sum(_line_length(line) for line in lines)
+    duration = _duration(geometry)
+    return [
+        round(length, 1),
+        round(duration, 1) if duration is not None else None,
+        bbox[0], bbox[1], bbox[2], bbox[3],
+        sum(len(line) for line in lines),
+        stat.st_mtime_ns,
+        stat.st_size
+    ]
+
+def _compute_chunk(trajectory_files):
+    rows = {}
+    for trajectory_file in trajectory_files:
+        try:
+            rows[os.path.basename(trajectory_file)] = compute_stats(trajectory_file)
+        except Exception as e:
+            # Malformed uploads (e.g. [null, null] coordinates) must not abort the whole batch
+            rows[os.path.basename(trajectory_file)] = None
+            logger.warning(f"Skipping unreadable trajectory {trajectory_file}: {e!r}")
+    return rows
+
+def load_index(data_dir):
+    """Return {filename: row} from the sidecar index (empty if missing or outdated)"""
+    index_file = index_path(data_dir)
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    if index.get('version') != INDEX_VERSION or index.get('fields') != FIELDS:
+        return {}
+    return dict(zip(index['files'], index['rows']))
+
+def save_index(data_dir, rows):
+    index_file = index_path(data_dir)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    files = sorted(rows)
+    index = {
+        'version': INDEX_VERSION,
+        'fields': FIELDS,
+        'files': files,
+        'rows': [rows[name] for name in files]
+    }
+    tmp_file = f"{index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_file, index_file)
+    # Older versions kept the index next to the uploads
+    try:
+        os.remove(os.path.join(data_dir, "uploads", INDEX_FILE))
+    except FileNotFoundError:
+        pass
+
+def update_index(data_dir, workers=None, rebuild=False):
+    """
+    Bring the sidecar index up to date with uploads/trajectories.
+    Only new or modified files are read; with more than one file to process the
+    work is spread over a process pool. Returns (rows, number of files computed).
+    """
+    trajectories_dir = os.path.join(data_dir, "uploads", "trajectories")
+    rows = {} if rebuild else load_index(data_dir)
+
+    current = {}
+    if os.path.isdir(trajectories_dir):
+        for entry in os.scandir(trajectories_dir):
+            if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith('.tmp'):
+                current[entry.name] = entry.stat()
+
+    mtime_index, size_index = FIELDS.index('mtime_ns'), FIELDS.index('size')
+    pending = []
+    for name, stat in current.items():
+        row = rows.get(name)
+        if row is None or row[mtime_index] != stat.st_mtime_ns or row[size_index] != stat.st_size:
+            pending.append(os.path.join(trajectories_dir, name))
+
+    removed = [name for name in rows if name not in current]
+    for name in removed:
+        del rows[name]
+
+    if len(pending) > 1 and workers != 1:
+        workers = workers or os.cpu_count() or 1
+        chunk_size = max(1, len(pending) // (workers * 4))
+        chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk_rows in executor.map(_compute_chunk, chunks):
+                rows.update(chunk_rows)
+    elif pending:
+        rows.update(_compute_chunk(pending))
+
+    # Unparseable files are kept out of the index
+    rows = {name: row for name, row in rows.items() if row is not None}
+    if pending or removed or not os.path.exists(index_path(data_dir)):
+        save_index(data_dir, rows)
+    return rows, len(pending)
+
+class TrajectoryIndex:
+    """Read side of the sidecar index used by the data server"""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def reload(self):
+        rows = load_index(self.data_dir)
+        with self._lock:
+            self._rows = rows
+        return len(rows)
+
+    def refresh(self):
+        """Index new uploads incrementally and reload"""
+        rows, computed = update_index(self.data_dir, workers=1)
+        with self._lock:
+            self._rows = rows
+        return computed
+
+    def query(self, bbox=None, min_length=None, max_length=None, sort='length_m', descending=True, limit=100):
+        """Trajectories intersecting bbox and within the length range, as dicts"""
+        w, s, e, n = (FIELDS.index(f) for f in ('west', 'south', 'east', 'north'))
+        length_index = FIELDS.index('length_m')
+        with self._lock:
+            rows = list(self._rows.items())
+
+        matches = []
+        for name, row in rows:
+            if bbox and not (row[w] <= bbox[2] and row[e] >= bbox[0] and row[s] <= bbox[3] and row[n] >= bbox[1]):
+                continue
+            if min_length is not None and row[length_index] < min_length:
+                continue
+            if max_length is not None and row[length_index] > max_length:
+                continue
+            matches.append((name, row))
+
+        sort_index = FIELDS.index(sort)
+        # Missing values (e.g. no duration) always sort last
+        present = [m for m in matches if m[1][sort_index] is not None]
+        missing = [m for m in matches if m[1][sort_index] is None]
+        present.sort(key=lambda m: m[1][sort_index], reverse=descending)
+
+        results = []
+        for name, row in (present + missing)[:limit]:
+            result = dict(zip(FIELDS[:7], row[:7]))
+            result['path'] = f"uploads/trajectories/{name}"
+            results.append(result)
+        return len(matches), results
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="Build the trajectory statistics sidecar index")
+    parser.add_argument('--data-dir', default="data", help="数据目录 (默认: data)")
+    parser.add_argument('--workers', type=int, default=None, help="进程数 (默认: CPU核数)")
+    parser.add_argument('--rebuild', action='store_true', help="忽略现有索引，全部重新计算")
+    args = parser.parse_args()
+
+    print("🛤️ 开始统计轨迹...")
+    if np is None:
+        print("⚠️ 未安装NumPy，使用纯Python计算（较慢）")
+    rows, computed = update_index(args.data_dir, workers=args.workers, rebuild=args.rebuild)
+
+    total_length = sum(row[0] for row in rows.values())
+    print(f"✅ 重新计算 {computed} 个轨迹，索引共 {len(rows)} 个")
+    print(f"   - 总长度: {total_length / 1000:.1f} km")
+    print(f"💾 索引已保存到: {index_path(args.data_dir)}")
+
+if __name__ == "__main__":
+    run_profiled(main)
@@ -9,6 +9,8 @@ import os
 import glob
 from datetime import datetime
 
+from profiling import run_profiled
+
 def get_latest_memories_file(memories_dir):
     """获取最新的memories汇总文件"""
     pattern = os.path.join(memories_dir, "memories-*.json")
@@ -108,4 +110,4 @@ def main():
     print(f"📅 更新时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_profiled(main)
\ No newline at end of file
@@ -4,20 +4,146 @@ UAL M2 - Simple File Server for User Data Management
 Handles saving and loading user registration data to/from data/users/ directory
 """
 
+import argparse
 import json
 import os
 import sys
 import base64
-import uuid
+import re
+import signal
+import threading
+import time
 from datetime import datetime
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 from urllib.parse import urlparse, parse_qs
 import logging
 
+from admission import AdmissionController, admission_controlled
+from change_feed import RESYNC, ChangeFeed, file_lock
+from job_queue import JobQueue
+from media_store import sanitize_extension, store_blob
+from profiling import Profiler, parse_rates, profiled_request
+from record_cache import RecordCache, DEFAULT_MAX_BYTES
+from search_index import SearchIndex
+from state_snapshot import (SnapshotWriter, diff_record_files, load_snapshot, record_file_signature,
+                            scan_record_files, snapshot_path, write_snapshot,
+                            DEFAULT_INTERVAL as DEFAULT_SNAPSHOT_INTERVAL)
+from tiles import TileCache
+from timeline_index import GRANULARITIES, TimelineIndex, parse_time
+from trajectory_stats import TrajectoryIndex, FIELDS as TRAJECTORY_FIELDS
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Seconds the pre-fork parent waits for workers that were signalled along with it before signalling
+# them itself (a worker ignores signals once it is shutting down, so a late one does no harm)
+SHUTDOWN_GRACE = 3
+
+TILE_PATH = re.compile(r'^/tiles/(\d+)/(\d+)/(\d+)(?:\.(geojson|json|mvt|pbf))?$')
+
+def write_json_atomic(path, data):
+    """Write a JSON file through a temporary file, so readers never see it half-written"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+class UserDataServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTPServer handling each request in its own thread (admission control bounds the heavy ones).
+    In pre-fork mode several worker processes accept on the same listening socket; record
+    writes are serialized with a file lock and announced on the change feed, and each worker
+    applies the other workers' changes to its caches and indexes before serving a request.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    changes = None
+    snapshot_seq = None
+    record_files = None   # (kind, record_id) -> (mtime_ns, size) of the file the in-memory state reflects
+
+    def write_lock(self):
+        """Serialize record writes across threads and worker processes"""
+        return file_lock(self.write_lock_path)
+
+    def index_memory(self, memory):
+        """Add or replace a memory in the in-memory indexes"""
+        self.search_index.add(memory)
+        self.timeline_index.add(memory)
+    
+    def unindex_memory(self, memory_id):
+        self.search_index.remove(memory_id)
+        self.timeline_index.remove(memory_id)
+    
+    def note_record_files(self, keys):
+        """Remember the on-disk signature of (kind, record_id) records just written or re-read"""
+        for kind, record_id in keys:
+            signature = record_file_signature(self.data_dir, kind, record_id)
+            if signature is None:
+                self.record_files.pop((kind, record_id), None)
+            else:
+                self.record_files[(kind, record_id)] = signature
+    
+    def reload_record_files(self, keys):
+        """Re-read (kind, record_id) records that were changed on disk without going through the server"""
+        for kind, record_id in keys:
+            self.record_cache.invalidate(kind, record_id)
+            if kind == 'memories':
+                memory_file_path = os.path.join(self.data_dir, kind, f"{record_id}.json")
+                if os.path.exists(memory_file_path):
+                    with open(memory_file_path, 'r', encoding='utf-8') as f:
+                        self.index_memory(json.load(f))
+                else:
+                    self.unindex_memory(record_id)
+        self.note_record_files(keys)
+        if any(kind == 'memories' for kind, _ in keys):
+            # Where those memories were before the edit is unknown, so no cached tile can be trusted
+            self.tile_cache.clear()
+    
+    def apply_changes(self):
+        """Drop or refresh in-memory state for records written by other worker processes"""
+        if self.changes is None:
+            return
+        entries = self.changes.poll()
+        if not entries:
+            return
+
+        if any(entry['kind'] == RESYNC for entry in entries):
+            # Entries this worker had not read yet were compacted away after a snapshot;
+            # catch up from that snapshot and the record files instead
+            with self.write_lock():
+                self.record_cache.clear()
+                load_state(self, self.data_dir, load_snapshot(snapshot_path(self.data_dir)))
+            self.tile_cache.reset()
+            self.trajectory_index.reload()
+            return
+
+        memories_dir = os.path.join(self.data_dir, "memories")
+        memories_changed = False
+        for entry in entries:
+            kind, record_id = entry['kind'], entry['id']
+            if kind in ('users', 'memories'):
+                self.record_cache.invalidate(kind, record_id)
+                self.note_record_files([(kind, record_id)])
+            if kind == 'memories':
+                memories_changed = True
+                memory_file_path = os.path.join(memories_dir, f"{record_id}.json")
+                # Holding the write lock guarantees the file is not half-written
+                with self.write_lock():
+                    if os.path.exists(memory_file_path):
+                        with open(memory_file_path, 'r', encoding='utf-8') as f:
+                            self.index_memory(json.load(f))
+                    else:
+                        self.unindex_memory(record_id)
+            elif kind == 'trajectories':
+                self.trajectory_index.reload()
+
+        if memories_changed:
+            # The writing worker already removed the affected tiles from the shared disk cache
+            self.tile_cache.reset()
+        logger.info(f"Applied {len(entries)} changes from other workers (seq {self.changes.last_seq})")
+
 class UserDataHandler(BaseHTTPRequestHandler):
     def __init__(self, *args, data_dir="data", **kwargs):
         self.data_dir = data_dir
@@ -28,6 +154,13 @@ class UserDataHandler(BaseHTTPRequestHandler):
         self.trajectories_dir = os.path.join(self.uploads_dir, "trajectories")
         super().__init__(*args, **kwargs)
     
+    def parse_request(self):
+        """Parse the request line and headers, then catch up with other workers' writes"""
+        if not super().parse_request():
+            return False
+        self.server.apply_changes()
+        return True
+    
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
         self.send_response(200)
@@ -36,9 +169,20 @@ class UserDataHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.end_headers()
     
+    @admission_controlled
+    @profiled_request
     def do_POST(self):
         """Handle saving user data and memories"""
         try:
+            # Writes only take JSON: a cross-origin page cannot send it without a CORS preflight,
+            # unlike the form and text/plain bodies browsers post anywhere
+            content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+            if content_type != 'application/json':
+                # Admission control has already bounded the body; reading it lets the client see the 415
+                self.rfile.read(int(self.headers['Content-Length']))
+                self._send_bad_request("Content-Type must be application/json", status=415)
+                return
+            
             if self.path == '/api/users/save':
                 content_length = int(self.headers['Content-Length'])
                 post_data = self.rfile.read(content_length)
@@ -50,8 +194,11 @@ class UserDataHandler(BaseHTTPRequestHandler):
                     user_file_path = os.path.join(self.users_dir, f"{user_id}.json")
                     os.makedirs(self.users_dir, exist_ok=True)
                     
-                    with open(user_file_path, 'w', encoding='utf-8') as f:
-                        json.dump(user_data, f, indent=2, ensure_ascii=False)
+                    with self.server.write_lock():
+                        write_json_atomic(user_file_path, user_data)
+                        self.server.record_cache.invalidate('users', user_id)
+                        self.server.note_record_files([('users', user_id)])
+                        self.server.changes.append([('users', user_id)])
                     
                     logger.info(f"Saved user data for {user_id} to {user_file_path}")
                     
@@ -73,14 +220,16 @@ class UserDataHandler(BaseHTTPRequestHandler):
                 all_users_file = os.path.join(self.users_dir, f"contributors-{timestamp}.json")
                 os.makedirs(self.users_dir, exist_ok=True)
                 
-                with open(all_users_file, 'w', encoding='utf-8') as f:
-                    json.dump(contributors_data, f, indent=2, ensure_ascii=False)
+                write_json_atomic(all_users_file, contributors_data)
                 
                 # Save individual files
-                for user_id, user_data in contributors_data.items():
-                    user_file_path = os.path.join(self.users_dir, f"{user_id}.json")
-                    with open(user_file_path, 'w', encoding='utf-8') as f:
-                        json.dump(user_data, f, indent=2, ensure_ascii=False)
+                with self.server.write_lock():
+                    for user_id, user_data in contributors_data.items():
+                        user_file_path = os.path.join(self.users_dir, f"{user_id}.json")
+                        write_json_atomic(user_file_path, user_data)
+                        self.server.record_cache.invalidate('users', user_id)
+                    self.server.note_record_files([('users', user_id) for user_id in contributors_data])
+                    self.server.changes.append([('users', user_id) for user_id in contributors_data])
                 
                 logger.info(f"Saved {len(contributors_data)} users to {self.users_dir}")
                 
@@ -104,14 +253,22 @@ class UserDataHandler(BaseHTTPRequestHandler):
                 all_memories_file = os.path.join(self.memories_dir, f"memories-{timestamp}.json")
                 os.makedirs(self.memories_dir, exist_ok=True)
                 
-                with open(all_memories_file, 'w', encoding='utf-8') as f:
-                    json.dump(memories_data, f, indent=2, ensure_ascii=False)
+                write_json_atomic(all_memories_file, memories_data)
                 
                 # Save individual memory files
-                for memory_id, memory_data in memories_data.items():
-                    memory_file_path = os.path.join(self.memories_dir, f"{memory_id}.json")
-                    with open(memory_file_path, 'w', encoding='utf-8') as f:
-                        json.dump(memory_data, f, indent=2, ensure_ascii=False)
+                touched_bboxes = []
+                with self.server.write_lock():
+                    for memory_id, memory_data in memories_data.items():
+                        memory_file_path = os.path.join(self.memories_dir, f"{memory_id}.json")
+                        touched_bboxes.extend(self._changed_memory_bboxes(memory_file_path, memory_data))
+                        write_json_atomic(memory_file_path, memory_data)
+                        self.server.record_cache.invalidate('memories', memory_id)
+                        self.server.index_memory(memory_data)
+                    
+                    # Only tiles under changed memories need to be rebuilt
+                    self.server.tile_cache.invalidate(touched_bboxes)
+                    self.server.note_record_files([('memories', memory_id) for memory_id in memories_data])
+                    self.server.changes.append([('memories', memory_id) for memory_id in memories_data])
                 
                 logger.info(f"Saved {len(memories_data)} memories to {self.memories_dir}")
                 
@@ -125,31 +282,67 @@ class UserDataHandler(BaseHTTPRequestHandler):
                     "file": all_memories_file
                 }).encode())
                 
+            elif self.path == '/api/memories/delete':
+                content_length = int(self.headers['Content-Length'])
+                post_data = self.rfile.read(content_length)
+                request = json.loads(post_data.decode('utf-8'))
+                
+                # Only the ids listed here are deleted; save-all never removes memories
+                memory_ids = request.get('ids') if isinstance(request, dict) else None
+                if not isinstance(memory_ids, list) or not all(
+                        isinstance(memory_id, str) and memory_id == os.path.basename(memory_id)
+                        and not memory_id.startswith('memories-') for memory_id in memory_ids):
+                    self._send_bad_request("Expected {\"ids\": [memory ids]}")
+                    return
+                
+                touched_bboxes = []
+                deleted_ids = []
+                with self.server.write_lock():
+                    for memory_id in memory_ids:
+                        memory_file_path = os.path.join(self.memories_dir, f"{memory_id}.json")
+                        if not os.path.isfile(memory_file_path):
+                            continue
+                        with open(memory_file_path, 'r', encoding='utf-8') as f:
+                            touched_bboxes.extend(self.server.tile_cache.memory_bboxes(json.load(f)))
+                        os.remove(memory_file_path)
+                        self.server.record_cache.invalidate('memories', memory_id)
+                        self.server.unindex_memory(memory_id)
+                        deleted_ids.append(memory_id)
+                    
+                    self.server.tile_cache.invalidate(touched_bboxes)
+                    self.server.note_record_files([('memories', memory_id) for memory_id in deleted_ids])
+                    self.server.changes.append([('memories', memory_id) for memory_id in deleted_ids])
+                
+                logger.info(f"Deleted {len(deleted_ids)} memories from {self.memories_dir}")
+                
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(json.dumps({
+                    "status": "success",
+                    "message": f"Deleted {len(deleted_ids)} memories",
+                    "deleted": deleted_ids
+                }).encode())
+                
             elif self.path == '/api/upload/image':
                 # Handle image upload
                 content_length = int(self.headers['Content-Length'])
                 post_data = self.rfile.read(content_length)
                 upload_data = json.loads(post_data.decode('utf-8'))
                 
-                # Create uploads directory if it doesn't exist
-                os.makedirs(self.images_dir, exist_ok=True)
-                
-                # Generate unique filename
-                file_extension = upload_data.get('extension', 'png')
-                file_id = str(uuid.uuid4())
-                filename = f"{file_id}.{file_extension}"
-                file_path = os.path.join(self.images_dir, filename)
-                
-                # Decode and save base64 image
+                # Decode base64 image
                 image_data = upload_data.get('data', '')
                 if ',' in image_data:
                     # Remove data URL prefix if present
                     image_data = image_data.split(',', 1)[1]
                 
-                with open(file_path, 'wb') as f:
-                    f.write(base64.b64decode(image_data))
+                # Store under the content hash so duplicate uploads share one file
+                file_extension = sanitize_extension(upload_data.get('extension'), 'png')
+                filename, created = store_blob(self.images_dir, base64.b64decode(image_data), file_extension)
+                file_path = os.path.join(self.images_dir, filename)
                 
-                logger.info(f"Saved image to {file_path}")
+                logger.info(f"{'Saved' if created else 'Reused existing'} image {file_path}")
                 
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/json')
@@ -167,21 +360,15 @@ class UserDataHandler(BaseHTTPRequestHandler):
                 post_data = self.rfile.read(content_length)
                 upload_data = json.loads(post_data.decode('utf-8'))
                 
-                # Create uploads directory if it doesn't exist
-                os.makedirs(self.trajectories_dir, exist_ok=True)
-                
-                # Generate unique filename
-                file_extension = upload_data.get('extension', 'json')
-                file_id = str(uuid.uuid4())
-                filename = f"{file_id}.{file_extension}"
-                file_path = os.path.join(self.trajectories_dir, filename)
-                
-                # Save trajectory data
+                # Store under the content hash so duplicate uploads share one file
+                file_extension = sanitize_extension(upload_data.get('extension'), 'json')
                 trajectory_data = upload_data.get('data', {})
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(trajectory_data, f, indent=2, ensure_ascii=False)
+                trajectory_bytes = json.dumps(trajectory_data, indent=2, ensure_ascii=False).encode('utf-8')
+                filename, created = store_blob(self.trajectories_dir, trajectory_bytes, file_extension)
+                file_path = os.path.join(self.trajectories_dir, filename)
                 
-                logger.info(f"Saved trajectory to {file_path}")
+                logger.info(f"{'Saved' if created else 'Reused existing'} trajectory {file_path}")
+                stats_job = self.server.job_queue.enqueue('trajectory_stats') if created else None
                 
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/json')
@@ -190,9 +377,45 @@ class UserDataHandler(BaseHTTPRequestHandler):
                 self.wfile.write(json.dumps({
                     "status": "success",
                     "filename": filename,
-                    "path": f"uploads/trajectories/{filename}"
+                    "path": f"uploads/trajectories/{filename}",
+                    "job_id": stats_job
                 }).encode())
                 
+            elif self.path == '/api/admin/profile':
+                # Change profiling mode / per-route rates at runtime
+                content_length = int(self.headers['Content-Length'])
+                post_data = self.rfile.read(content_length)
+                
+                # Browsers send Origin with every fetch POST; this is for curl on the server host only
+                if self.headers.get('Origin') is not None:
+                    self._send_bad_request("Profiling can only be changed from the server host", status=403)
+                    return
+                
+                profiler = self.server.profiler
+                try:
+                    settings = json.loads(post_data.decode('utf-8'))
+                    if not isinstance(settings, dict):
+                        raise ValueError("Expected a JSON object with mode and/or rates")
+                    rates = settings.get('rates')
+                    if isinstance(rates, (str, int, float)):
+                        rates = parse_rates(rates)
+                    elif isinstance(rates, dict):
+                        rates = parse_rates(','.join(f"{route}={rate}" for route, rate in rates.items()))
+                    elif rates is not None:
+                        raise ValueError("rates must be a rate, a \"route=rate,...\" string or a {route: rate} object")
+                    profiler.configure(settings.get('mode', profiler.mode), rates)
+                except ValueError as e:
+                    self._send_bad_request(str(e))
+                    return
+                
+                logger.info(f"Profiling set to {profiler.mode} with rates {profiler.rates}")
+                
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(json.dumps(profiler.stats()).encode())
+                
             else:
                 self.send_response(404)
                 self.end_headers()
@@ -205,10 +428,192 @@ class UserDataHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
     
+    def _changed_memory_bboxes(self, memory_file_path, memory_data):
+        """Map areas a memory covered before and after a save, or [] if it is unchanged"""
+        old_memory = None
+        if os.path.exists(memory_file_path):
+            with open(memory_file_path, 'r', encoding='utf-8') as f:
+                old_memory = json.load(f)
+        if old_memory == memory_data:
+            return []
+        
+        tile_cache = self.server.tile_cache
+        bboxes = tile_cache.memory_bboxes(memory_data)
+        if old_memory:
+            bboxes.extend(tile_cache.memory_bboxes(old_memory))
+        return bboxes
+    
+    def _send_tile(self, match):
+        """Serve a GeoJSON or Mapbox Vector Tile from the tile cache"""
+        z, x, y = (int(v) for v in match.group(1, 2, 3))
+        extension = match.group(4)
+        tile_cache = self.server.tile_cache
+        
+        if extension in ('mvt', 'pbf') or (extension is None and tile_cache.mvt_available):
+            fmt, content_type = 'mvt', 'application/vnd.mapbox-vector-tile'
+        else:
+            fmt, content_type = 'geojson', 'application/geo+json'
+        
+        try:
+            body = tile_cache.get_tile(z, x, y, fmt)
+        except ValueError as e:
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_record(self, kind, records_dir, record_id):
+        """Serve a single user or memory record, going through the LRU record cache"""
+        record_cache = self.server.record_cache
+        cached = record_cache.get(kind, record_id)
+        if cached is not None:
+            body = cached[1]
+        else:
+            # Taken before reading, so a save that lands in between keeps the stale copy out of the cache
+            generation = record_cache.generation(kind, record_id)
+            record_file_path = os.path.join(records_dir, f"{record_id}.json")
+            if not os.path.exists(record_file_path):
+                self.send_response(404)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                return
+            
+            with open(record_file_path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            body = json.dumps(record).encode()
+            record_cache.put(kind, record_id, record, body, generation=generation)
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_search_results(self, params):
+        """Ranked, paginated full-text search over memory titles, descriptions and contributors"""
+        query = params.get('q', [''])[0]
+        try:
+            page = max(1, int(params.get('page', ['1'])[0]))
+            per_page = max(1, min(100, int(params.get('per_page', ['20'])[0])))
+        except ValueError:
+            self._send_bad_request("page and per_page must be integers")
+            return
+        
+        total, results = self.server.search_index.search(query, offset=(page - 1) * per_page, limit=per_page)
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps({
+            "query": query,
+            "total": total,
+            "page": page,
+            "per_page": per_page,
+            "results": results
+        }, ensure_ascii=False).encode('utf-8'))
+    
+    def _send_trajectory_query(self, params):
+        """Filter and sort trajectories by bbox and length using the statistics sidecar index"""
+        try:
+            bbox = None
+            if 'bbox' in params:
+                bbox = [float(v) for v in params['bbox'][0].split(',')]
+                if len(bbox) != 4:
+                    raise ValueError("bbox must be west,south,east,north")
+            min_length = float(params['min_length'][0]) if 'min_length' in params else None
+            max_length = float(params['max_length'][0]) if 'max_length' in params else None
+            sort = params.get('sort', ['length_m'])[0]
+            if sort not in TRAJECTORY_FIELDS:
+                raise ValueError(f"Unknown sort field: {sort}")
+            descending = params.get('order', ['desc'])[0] != 'asc'
+            limit = max(1, min(1000, int(params.get('limit', ['100'])[0])))
+        except ValueError as e:
+            self._send_bad_request(str(e))
+            return
+        
+        total, results = self.server.trajectory_index.query(
+            bbox=bbox, min_length=min_length, max_length=max_length,
+            sort=sort, descending=descending, limit=limit
+        )
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps({"total": total, "results": results}).encode())
+    
+    def _send_bad_request(self, message, status=400):
+        """Error response (400 unless given) for invalid query parameters or request bodies"""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps({"status": "error", "message": message}).encode())
+    
+    def _send_timeline(self, params):
+        """Time-range slice of memories plus a day/week/month histogram, answered from the timeline index"""
+        try:
+            start = end = None
+            if 'start' in params:
+                start = parse_time(params['start'][0])
+                if start is None:
+                    raise ValueError("start must be an ISO 8601 date or time, a year or a year-month")
+            if 'end' in params:
+                end = parse_time(params['end'][0])
+                if end is None:
+                    raise ValueError("end must be an ISO 8601 date or time, a year or a year-month")
+            user = params.get('user', [None])[0]
+            granularity = params.get('granularity', ['month'])[0]
+            if granularity not in GRANULARITIES:
+                raise ValueError(f"Unknown granularity: {granularity} (expected one of {', '.join(GRANULARITIES)})")
+            descending = params.get('order', ['asc'])[0] == 'desc'
+            offset = max(0, int(params.get('offset', ['0'])[0]))
+            limit = max(0, min(1000, int(params.get('limit', ['100'])[0])))
+        except ValueError as e:
+            self._send_bad_request(str(e))
+            return
+        
+        timeline_index = self.server.timeline_index
+        total, results = timeline_index.query(start=start, end=end, user=user, offset=offset,
+                                              limit=limit, descending=descending)
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps({
+            "user": user,
+            "start": params.get('start', [None])[0],
+            "end": params.get('end', [None])[0],
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "granularity": granularity,
+            "histogram": timeline_index.histogram(granularity, user=user, start=start, end=end),
+            "results": results
+        }, ensure_ascii=False).encode('utf-8'))
+    
+    @admission_controlled
+    @profiled_request
     def do_GET(self):
         """Handle loading user data and memories"""
         try:
-            if self.path == '/api/users/list':
+            tile_match = TILE_PATH.match(urlparse(self.path).path)
+            if tile_match:
+                self._send_tile(tile_match)
+                
+            elif self.path == '/api/users/list':
                 # List all user files
                 if not os.path.exists(self.users_dir):
                     users = {}
@@ -246,43 +651,59 @@ class UserDataHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(json.dumps(memories).encode())
                 
-            elif self.path.startswith('/api/users/'):
-                # Get specific user
-                user_id = self.path.split('/')[-1]
-                user_file_path = os.path.join(self.users_dir, f"{user_id}.json")
+            elif self.path == '/api/stats':
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(json.dumps({
+                    "record_cache": self.server.record_cache.stats(),
+                    "profiling": self.server.profiler.stats(),
+                    "job_queue": self.server.job_queue.stats(),
+                    "admission": self.server.admission.stats()
+                }).encode())
                 
-                if os.path.exists(user_file_path):
-                    with open(user_file_path, 'r', encoding='utf-8') as f:
-                        user_data = json.load(f)
-                    
+            elif urlparse(self.path).path == '/api/memories/search':
+                self._send_search_results(parse_qs(urlparse(self.path).query))
+                
+            elif urlparse(self.path).path == '/api/trajectories/query':
+                self._send_trajectory_query(parse_qs(urlparse(self.path).query))
+                
+            elif urlparse(self.path).path == '/api/timeline':
+                self._send_timeline(parse_qs(urlparse(self.path).query))
+                
+            elif self.path == '/api/admin/profile':
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(json.dumps(self.server.profiler.stats()).encode())
+                
+            elif self.path.startswith('/api/jobs/'):
+                # Background job status
+                job_id = self.path.split('/')[-1]
+                job = self.server.job_queue.get(int(job_id)) if job_id.isdigit() else None
+                
+                if job is not None:
                     self.send_response(200)
                     self.send_header('Content-Type', 'application/json')
                     self.send_header('Access-Control-Allow-Origin', '*')
                     self.end_headers()
-                    self.wfile.write(json.dumps(user_data).encode())
+                    self.wfile.write(json.dumps(job, ensure_ascii=False).encode('utf-8'))
                 else:
                     self.send_response(404)
                     self.send_header('Access-Control-Allow-Origin', '*')
                     self.end_headers()
+                
+            elif self.path.startswith('/api/users/'):
+                # Get specific user
+                user_id = self.path.split('/')[-1]
+                self._send_record('users', self.users_dir, user_id)
                     
             elif self.path.startswith('/api/memories/'):
                 # Get specific memory
                 memory_id = self.path.split('/')[-1]
-                memory_file_path = os.path.join(self.memories_dir, f"{memory_id}.json")
-                
-                if os.path.exists(memory_file_path):
-                    with open(memory_file_path, 'r', encoding='utf-8') as f:
-                        memory_data = json.load(f)
-                    
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps(memory_data).encode())
-                else:
-                    self.send_response(404)
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
+                self._send_record('memories', self.memories_dir, memory_id)
             else:
                 self.send_response(404)
                 self.end_headers()
@@ -295,6 +716,16 @@ class UserDataHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
 
+def stop_on_signal(signum, frame):
+    """
+    SIGINT/SIGTERM handler: exit the main loop once. Ctrl+C and systemd signal the whole process
+    group and the pre-fork parent may signal again, so further signals are ignored while the job
+    queue and the shutdown snapshot finish.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
 def create_handler(data_dir):
     """Create a handler class with the specified data directory"""
     class Handler(UserDataHandler):
@@ -302,9 +733,214 @@ def create_handler(data_dir):
             super().__init__(*args, data_dir=data_dir, **kwargs)
     return Handler
 
+def init_server_state(server, data_dir):
+    """Load caches and indexes; in pre-fork mode this runs once before forking so workers share it"""
+    server.data_dir = data_dir
+    server.write_lock_path = os.path.join(data_dir, "cache", "write.lock")
+    server.changes = ChangeFeed(os.path.join(data_dir, "cache", "changes.log"))
+    snapshot = load_snapshot(snapshot_path(data_dir))
+    # Everything below is read from disk, so earlier feed entries are already reflected in it;
+    # the snapshot's feed position saves parsing the entries it covers
+    server.changes.skip_to_end(snapshot.get('feed') if snapshot is not None else None)
+    
+    server.admission = AdmissionController.from_env()
+    server.profiler = Profiler.from_env()
+    server.tile_cache = TileCache(data_dir, write_lock=server.write_lock,
+                                  external_generation=server.changes.end_offset)
+    server.record_cache = RecordCache(int(os.environ.get('UAL_M2_RECORD_CACHE_BYTES', DEFAULT_MAX_BYTES)))
+    load_state(server, data_dir, snapshot)
+    server.trajectory_index = TrajectoryIndex(data_dir)
+    server.trajectory_index.refresh()
+    logger.info(f"Loaded statistics for {len(server.trajectory_index)} trajectories")
+
+def load_state(server, data_dir, snapshot):
+    """
+    Restore indexes and caches from a state snapshot (or None), re-reading only record files
+    changed since. The indexes are built aside and swapped in, so this can also run live.
+    """
+    started = time.monotonic()
+    files = scan_record_files(data_dir)
+    search_index = SearchIndex()
+    timeline_index = TimelineIndex()
+    if snapshot is not None:
+        sections = snapshot['sections']
+        search_index.restore_state(sections['search'])
+        timeline_index.restore_state(sections['timeline'])
+        server.record_cache.restore_state(sections['record_cache'])
+        old_files = snapshot['files']
+    else:
+        old_files = {}
+    
+    changed, removed = diff_record_files(old_files, files)
+    for kind, record_id in removed:
+        server.record_cache.invalidate(kind, record_id)
+        if kind == 'memories':
+            search_index.remove(record_id)
+            timeline_index.remove(record_id)
+    for kind, record_id in changed:
+        server.record_cache.invalidate(kind, record_id)
+        if kind == 'memories':
+            with open(os.path.join(data_dir, kind, f"{record_id}.json"), 'r', encoding='utf-8') as f:
+                memory = json.load(f)
+            search_index.add(memory)
+            timeline_index.add(memory)
+    server.search_index, server.timeline_index = search_index, timeline_index
+    server.record_files = files
+    # Tiles on disk outlive restarts. Without a snapshot, or with memories changed since it was
+    # written, it is unknown which areas changed, so none of them can be trusted
+    if snapshot is None or any(kind == 'memories' for kind, _ in changed + removed):
+        server.tile_cache.clear()
+    
+    # A snapshot that needed replaying is rewritten at the next opportunity
+    if snapshot is not None and not changed and not removed:
+        server.snapshot_seq = snapshot['seq']
+    source = f"snapshot (seq {snapshot['seq']})" if snapshot is not None else "record files"
+    logger.info(f"Loaded state from {source}, re-read {len(changed)} changed and dropped {len(removed)} "
+                f"removed record files in {time.monotonic() - started:.2f}s; "
+                f"{len(search_index)} memories indexed for search, {len(timeline_index)} on the timeline")
+
+def write_state_snapshot(server, force=False):
+    """
+    Pack indexes and caches so the next boot only re-reads record files changed after this point.
+    Record files edited outside the server are re-read first, even when the snapshot is then skipped.
+    """
+    server.apply_changes()
+    # Scanning under the write lock means every change seen here has reached the change feed,
+    # so applying the feed afterwards brings the indexes at least up to the scan
+    with server.write_lock():
+        files = scan_record_files(server.data_dir)
+    server.apply_changes()
+    # Whatever still differs from what the state was built from was changed behind the server's
+    # back (git pull, fix scripts); re-read it so the snapshot does not mark stale state as current
+    with server.write_lock():
+        changed, removed = diff_record_files(dict(server.record_files), files)
+        if changed or removed:
+            server.reload_record_files(changed + removed)
+            server.changes.append(changed + removed)
+            logger.info(f"Re-read {len(changed)} record files changed and dropped {len(removed)} "
+                        f"removed outside the server")
+    server.apply_changes()
+    seq = server.changes.last_seq
+    if not force and seq == server.snapshot_seq:
+        return
+    sections = {
+        'search': server.search_index.export_state(),
+        'timeline': server.timeline_index.export_state(),
+        'record_cache': server.record_cache.export_state()
+    }
+    # Entries up to seq are covered by this snapshot; workers that had not read them yet resync from it
+    feed = server.changes.compact(seq)
+    size = write_snapshot(snapshot_path(server.data_dir), seq, files, sections, feed=feed)
+    server.snapshot_seq = seq
+    logger.info(f"Wrote state snapshot at seq {seq} ({size} bytes), compacted the change feed")
+
+def start_snapshot_writer(server):
+    """Write the state snapshot periodically and on shutdown"""
+    interval = float(os.environ.get('UAL_M2_SNAPSHOT_INTERVAL', DEFAULT_SNAPSHOT_INTERVAL))
+    server.snapshot_writer = SnapshotWriter(lambda force=False: write_state_snapshot(server, force), interval)
+    server.snapshot_writer.start()
+
+def start_job_queue(server, data_dir, run_workers=True):
+    """Open the job queue; only one process runs the job workers, the others just enqueue"""
+    def refresh_trajectory_stats(payload):
+        computed = server.trajectory_index.refresh()
+        server.changes.append([('trajectories', None)])
+        return {"computed": computed}
+    
+    # Post-upload work runs off the request path
+    server.job_queue = JobQueue(os.path.join(data_dir, "jobs.sqlite3"),
+                                workers=int(os.environ.get('UAL_M2_JOB_WORKERS', 2)))
+    server.job_queue.register('trajectory_stats', refresh_trajectory_stats)
+    if run_workers:
+        server.job_queue.start()
+
+def serve_worker(server, data_dir, worker_id):
+    """Run one worker process of the pre-fork server until it is told to stop"""
+    start_job_queue(server, data_dir, run_workers=(worker_id == 0))
+    # Worker 0 also owns the state snapshot; the other workers' state converges through the change feed
+    if worker_id == 0:
+        start_snapshot_writer(server)
+    logger.info(f"Worker {worker_id} (pid {os.getpid()}) ready")
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.job_queue.stop()
+        if worker_id == 0:
+            server.snapshot_writer.stop()
+
+def run_prefork(server, data_dir, workers):
+    """Fork workers that share the listening socket and restart any that die"""
+    children = {}
+    
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                serve_worker(server, data_dir, worker_id)
+            except BaseException as e:
+                logger.error(f"Worker {worker_id} failed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children[pid] = worker_id
+    
+    for worker_id in range(workers):
+        spawn(worker_id)
+    
+    try:
+        while True:
+            pid, status = os.wait()
+            worker_id = children.pop(pid, None)
+            if worker_id is None:
+                continue
+            logger.warning(f"Worker {worker_id} (pid {pid}) exited with status {status}, restarting")
+            # Avoid a tight restart loop if workers crash on startup
+            time.sleep(1)
+            spawn(worker_id)
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Server stopped, stopping workers")
+        # Workers signalled along with the parent are already shutting down; only those
+        # still running after the grace period are told to stop
+        deadline = time.monotonic() + SHUTDOWN_GRACE
+        while children and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    finally:
+        server.server_close()
+
 def main():
-    port = 3001
-    data_dir = "data"
+    parser = argparse.ArgumentParser(description="UAL M2 user data server")
+    parser.add_argument('--port', type=int, default=3001, help="port to listen on (default: 3001)")
+    parser.add_argument('--data-dir', default="data", help="data directory (default: data)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('UAL_M2_WORKERS', 1)),
+                        help="worker processes sharing the listening socket (default: UAL_M2_WORKERS or 1)")
+    args = parser.parse_args()
+    
+    port = args.port
+    data_dir = args.data_dir
+    workers = max(1, args.workers)
+    if workers > 1 and not hasattr(os, 'fork'):
+        logger.warning("Pre-fork mode needs os.fork, running a single process")
+        workers = 1
     
     # Ensure data directories exist
     users_dir = os.path.join(data_dir, "users")
@@ -319,9 +955,10 @@ def main():
     os.makedirs(trajectories_dir, exist_ok=True)
     
     handler_class = create_handler(data_dir)
-    server = HTTPServer(('localhost', port), handler_class)
+    server = UserDataServer(('localhost', port), handler_class)
+    init_server_state(server, data_dir)
     
-    logger.info(f"Starting UAL M2 User Data Server on port {port}")
+    logger.info(f"Starting UAL M2 User Data Server on port {port} with {workers} worker process(es)")
     logger.info(f"Users directory: {os.path.abspath(users_dir)}")
     logger.info(f"Memories directory: {os.path.abspath(memories_dir)}")
     logger.info(f"Uploads directory: {os.path.abspath(uploads_dir)}")
@@ -329,18 +966,42 @@ def main():
     logger.info("  POST /api/users/save - Save individual user")
     logger.info("  POST /api/users/save-all - Save all users")
     logger.info("  POST /api/memories/save-all - Save all memories")
+    logger.info("  POST /api/memories/delete - Delete memories by id")
     logger.info("  POST /api/upload/image - Upload image file")
     logger.info("  POST /api/upload/trajectory - Upload trajectory file")
     logger.info("  GET  /api/users/list - List all users")
     logger.info("  GET  /api/memories/list - List all memories")
     logger.info("  GET  /api/users/{id} - Get specific user")
     logger.info("  GET  /api/memories/{id} - Get specific memory")
+    logger.info("  GET  /api/memories/search?q= - Search memories")
+    logger.info("  GET  /api/trajectories/query?bbox=&min_length= - Query trajectory statistics")
+    logger.info("  GET  /api/timeline?start=&end=&user=&granularity= - Memories over time")
+    logger.info("  GET  /api/jobs/{id} - Background job status")
+    logger.info("  GET  /api/stats - Server cache statistics")
+    logger.info("  GET/POST /api/admin/profile - Show or change request profiling")
+    logger.info("  GET  /tiles/{z}/{x}/{y}[.geojson|.mvt] - Memory and trajectory tiles")
+    
+    if server.profiler.enabled:
+        logger.info(f"Profiling {server.profiler.mode} mode, rates {server.profiler.rates}, "
+                    f"output {os.path.abspath(server.profiler.output_dir)}")
+    
+    # run.sh and service managers stop the server with SIGTERM; pre-fork workers inherit these handlers too
+    signal.signal(signal.SIGINT, stop_on_signal)
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    if workers > 1:
+        run_prefork(server, data_dir, workers)
+        return
     
+    start_job_queue(server, data_dir)
+    start_snapshot_writer(server)
     try:
         server.serve_forever()
-    except KeyboardInterrupt:
-        logger.info("Server stopped by user")
-        server.shutdown()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Server stopped")
+    finally:
+        server.job_queue.stop()
+        server.snapshot_writer.stop()
+        server.server_close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the background job queue (scripts/job_queue.py)
+Run with: python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from job_queue import JobQueue
+
+class JobQueueRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "jobs.sqlite3")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_restart_with_running_job_and_identical_pending_job(self):
+        queue = JobQueue(self.db_path, workers=0)
+        first = queue.enqueue('trajectory_stats')
+        self.assertEqual(queue._claim()['id'], first)
+        # A second trajectory upload queues the same job while the first one is running
+        second = queue.enqueue('trajectory_stats')
+        self.assertNotEqual(first, second)
+
+        # The process dies here; the next boot must recover instead of failing on the dedup index
+        restarted = JobQueue(self.db_path, workers=0)
+        restarted.start()
+        self.assertEqual(restarted.get(first)['status'], 'failed')
+        self.assertEqual(restarted.get(second)['status'], 'pending')
+        restarted.stop()
+
+    def test_restart_recovers_lone_running_job(self):
+        queue = JobQueue(self.db_path, workers=0)
+        job_id = queue.enqueue('trajectory_stats')
+        queue._claim()
+
+        restarted = JobQueue(self.db_path, workers=0)
+        restarted.start()
+        self.assertEqual(restarted.get(job_id)['status'], 'pending')
+        restarted.stop()
+
+class JobQueueClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.queue = JobQueue(os.path.join(self.tmp_dir.name, "jobs.sqlite3"), workers=0)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_identical_job_waits_while_one_is_running(self):
+        first = self.queue.enqueue('trajectory_stats')
+        self.assertEqual(self.queue._claim()['id'], first)
+        second = self.queue.enqueue('trajectory_stats')
+        other = self.queue.enqueue('trajectory_stats', {'rebuild': True})
+
+        # Only the job with a different payload may start until the first identical one finishes
+        self.assertEqual(self.queue._claim()['id'], other)
+        self.assertIsNone(self.queue._claim())
+        self.queue._finish(self.queue.get(first), result={})
+        self.assertEqual(self.queue._claim()['id'], second)
+
+if __name__ == "__main__":
+    unittest.main()